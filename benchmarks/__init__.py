@@ -0,0 +1,6 @@
+"""
+Benchmarks for the Recommendations service
+
+Run them from the repository root, e.g.
+  python -m benchmarks.serialization
+"""
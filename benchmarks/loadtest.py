@@ -0,0 +1,254 @@
+"""
+HTTP load test
+
+Starts the service under gunicorn, seeds it with Recommendations, and
+replays a traffic mix from concurrent keep-alive clients. It reports the
+throughput and the p50/p95/p99 latency of every route, for each combination
+of gunicorn workers, threads and client concurrency:
+
+  python -m benchmarks.loadtest --workers 1,2,4 --threads 1,4 --concurrency 8,32 --duration 20
+
+The mix weighs these routes, products are picked with Zipf popularity:
+  group    GET /api/recommendations/{id}?type={type}
+  pair     GET /api/recommendations/{id}/recommended-products/{id}
+  like     PUT /api/recommendations/{id}/recommended-products/{id}/like
+  create   POST /api/recommendations
+
+For every server configuration the saturation point is the first
+concurrency whose throughput grew less than --saturation over the previous
+one. The benchmark drops the data of the database it is given.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import itertools
+import threading
+import subprocess
+import http.client
+from benchmarks.models import ZipfProducts, RELATIONSHIPS, summarize
+
+ROUTES = ("group", "pair", "like", "create")
+
+
+def parse_mix(text):
+    """ Parses "group=70,pair=15" into the routes and their weights """
+    mix = dict((name, float(weight)) for name, weight in (part.split("=") for part in text.split(",")))
+    unknown = set(mix) - set(ROUTES)
+    if unknown:
+        raise argparse.ArgumentTypeError("unknown routes {}".format(", ".join(sorted(unknown))))
+    return mix
+
+
+class Server:
+    """ A gunicorn process serving the app on a local port """
+
+    def __init__(self, port, workers, threads, database):
+        self.port = port
+        env = dict(os.environ, DATABASE_URI=database, GUNICORN_WORKERS=str(workers),
+                   GUNICORN_THREADS=str(threads), LOG_INFO_SAMPLE_RATE=os.getenv("LOG_INFO_SAMPLE_RATE", "0"))
+        self.process = subprocess.Popen(
+            [shutil.which("gunicorn") or "gunicorn", "--config=gunicorn.conf.py", "--bind=127.0.0.1:{}".format(port),
+             "--log-level=warning", "service:app"],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("gunicorn exited with {}".format(self.process.returncode))
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                connection.request("GET", "/api/internal/pool")
+                if connection.getresponse().status == 200:
+                    return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("gunicorn did not start within {}s".format(timeout))
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def request(connection, method, url, body=None):
+    """ Sends one request and returns its status, reading the whole response """
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    connection.request(method, url, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def seed(port, products, per_product, rng):
+    """ Clears the service and loads per_product Recommendations for each product, returns the pairs """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    request(connection, "DELETE", "/api/recommendations")
+    pairs = []
+    batch = []
+    count = len(products.population)
+    for product_id in products.population:
+        for recommendation_product_id in rng.sample(range(1, count + 1), min(per_product, count)):
+            relationship = rng.choice(RELATIONSHIPS)
+            pairs.append((product_id, recommendation_product_id, relationship))
+            batch.append({"product_id": product_id, "recommendation_product_id": recommendation_product_id,
+                          "relationship": relationship})
+            if len(batch) >= 1000:
+                request(connection, "POST", "/api/recommendations/batch", batch)
+                batch = []
+    if batch:
+        request(connection, "POST", "/api/recommendations/batch", batch)
+    return pairs
+
+
+class Client(threading.Thread):
+    """ Sends requests from the mix over one keep-alive connection until stopped """
+
+    def __init__(self, port, mix, products, by_product, new_ids, seed, stop, record_after):
+        super().__init__(daemon=True)
+        self.port = port
+        self.routes, self.weights = list(mix), list(mix.values())
+        self.products = products
+        self.rng = random.Random(seed)
+        self.by_product = by_product
+        self.new_ids = new_ids
+        self.stop = stop
+        self.record_after = record_after
+        self.samples = {route: [] for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+
+    def next_request(self, route):
+        product_id = self.products.draw(rng=self.rng)[0]
+        recommendation_product_id, relationship = self.rng.choice(self.by_product[product_id])
+        pair = "/api/recommendations/{}/recommended-products/{}".format(product_id, recommendation_product_id)
+        if route == "group":
+            return "GET", "/api/recommendations/{}?type={}".format(product_id, relationship), None
+        if route == "pair":
+            return "GET", pair, None
+        if route == "like":
+            return "PUT", pair + "/like", None
+        return "POST", "/api/recommendations", {
+            "product_id": next(self.new_ids), "recommendation_product_id": product_id, "relationship": relationship
+        }
+
+    def run(self):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        while not self.stop.is_set():
+            route = self.rng.choices(self.routes, self.weights)[0]
+            method, url, body = self.next_request(route)
+            start = time.perf_counter()
+            try:
+                ok = request(connection, method, url, body) < 500
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+                ok = False
+            if start < self.record_after:
+                continue  # warming up
+            self.samples[route].append(time.perf_counter() - start)
+            if not ok:
+                self.errors[route] += 1
+        connection.close()
+
+
+def run_load(port, mix, products, by_product, new_ids, concurrency, duration, warmup, seed):
+    """ Runs the mix from concurrency clients, returns the report of each route and of all of them """
+    stop = threading.Event()
+    record_after = time.perf_counter() + warmup
+    clients = [Client(port, mix, products, by_product, new_ids, seed + n, stop, record_after)
+               for n in range(concurrency)]
+    for client in clients:
+        client.start()
+    time.sleep(warmup + duration)
+    stop.set()
+    for client in clients:
+        client.join()
+
+    report = {}
+    everything = []
+    for route in ROUTES:
+        samples = [sample for client in clients for sample in client.samples[route]]
+        if not samples:
+            continue
+        everything.extend(samples)
+        report[route] = dict(summarize(samples), errors=sum(client.errors[route] for client in clients),
+                             requests_per_second=len(samples) / duration)
+    if everything:
+        report["all"] = dict(summarize(everything), errors=sum(r["errors"] for r in report.values()),
+                             requests_per_second=len(everything) / duration)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=os.getenv("BENCH_DATABASE_URI", "sqlite:////tmp/recommendations-load.db"),
+                        help="database the service uses, its data is dropped")
+    parser.add_argument("--workers", default="2", help="comma separated gunicorn worker counts")
+    parser.add_argument("--threads", default="1", help="comma separated gunicorn thread counts")
+    parser.add_argument("--concurrency", default="4,16", help="comma separated numbers of concurrent clients")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("group=70,pair=15,like=10,create=5"),
+                        help="route weights")
+    parser.add_argument("--products", type=int, default=1000, help="products to seed")
+    parser.add_argument("--per-product", type=int, default=20, help="Recommendations seeded per product")
+    parser.add_argument("--zipf", type=float, default=1.1, help="exponent of the product popularity distribution")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds before each run")
+    parser.add_argument("--saturation", type=float, default=0.1, help="throughput growth below which a run is saturated")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="file to write the JSON results to, defaults to stdout")
+    options = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    products = ZipfProducts(options.products, options.zipf, rng)
+    # created products get ids above the seeded ones, shared by all clients and runs
+    new_ids = itertools.count(options.products + 1)
+    records = []
+    for workers in [int(n) for n in options.workers.split(",")]:
+        for threads in [int(n) for n in options.threads.split(",")]:
+            server = Server(options.port, workers, threads, options.database)
+            try:
+                server.wait_ready()
+                by_product = {}
+                for product_id, recommendation_product_id, relationship in seed(options.port, products,
+                                                                                 options.per_product, rng):
+                    by_product.setdefault(product_id, []).append((recommendation_product_id, relationship))
+                previous = None
+                for concurrency in [int(n) for n in options.concurrency.split(",")]:
+                    report = run_load(options.port, options.mix, products, by_product, new_ids, concurrency,
+                                      options.duration, options.warmup, options.seed)
+                    throughput = report.get("all", {}).get("requests_per_second", 0.0)
+                    saturated = previous is not None and throughput < previous * (1 + options.saturation)
+                    previous = throughput
+                    records.append({"workers": workers, "threads": threads, "concurrency": concurrency,
+                                    "saturated": saturated, "routes": report})
+                    print("workers={} threads={} concurrency={}: {:.0f} req/s p50 {:.1f}ms p99 {:.1f}ms{}".format(
+                        workers, threads, concurrency, throughput,
+                        report.get("all", {}).get("p50_seconds", 0) * 1000,
+                        report.get("all", {}).get("p99_seconds", 0) * 1000,
+                        " (saturated)" if saturated else ""), file=sys.stderr)
+            finally:
+                server.stop()
+
+    best = max(records, key=lambda record: record["routes"].get("all", {}).get("requests_per_second", 0.0))
+    results = {
+        "database": options.database.split(":", 1)[0],
+        "mix": options.mix,
+        "duration": options.duration,
+        "best": {key: best[key] for key in ("workers", "threads", "concurrency")},
+        "results": records,
+    }
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,4 +14,114 @@ if 'VCAP_SERVICES' in os.environ:
     DATABASE_URI = vcap['user-provided'][0]['credentials']['url']
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
-SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# DB_POOL_SIZE and DB_MAX_OVERFLOW are derived from GUNICORN_WORKERS below
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Postgres cancels statements running longer than this, 0 disables the timeout
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Keyset pagination for the list endpoint
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Rows fetched per round trip by the streaming export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+# Records written per transaction by "flask import-recommendations"
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+
+# Batch creation limits
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "10000"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "500"))
+
+# Write-behind mode for likes, buffer likes per worker and flush them in batches
+LIKE_WRITE_BEHIND = os.getenv("LIKE_WRITE_BEHIND", "false").lower() == "true"
+LIKE_FLUSH_INTERVAL_MS = int(os.getenv("LIKE_FLUSH_INTERVAL_MS", "100"))
+LIKE_FLUSH_MAX_PENDING = int(os.getenv("LIKE_FLUSH_MAX_PENDING", "1000"))
+
+# Top-N ranked recommendations
+TOP_LIMIT_DEFAULT = int(os.getenv("TOP_LIMIT_DEFAULT", "10"))
+TOP_LIMIT_MAX = int(os.getenv("TOP_LIMIT_MAX", "100"))
+
+# In-process read-through cache for single pairs and product groups
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "false").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+
+# Most product ids that can be looked up in one request
+MAX_PRODUCT_IDS = int(os.getenv("MAX_PRODUCT_IDS", "100"))
+
+# Most (product_id, recommendation_product_id) pairs that can be looked up in one request
+LOOKUP_MAX_PAIRS = int(os.getenv("LOOKUP_MAX_PAIRS", "1000"))
+
+# Most products whose Recommendations can be deleted in one POST /recommendations/retire
+RETIRE_MAX_PRODUCTS = int(os.getenv("RETIRE_MAX_PRODUCTS", "1000"))
+
+# Serving. With GUNICORN_PRELOAD the app and schema are initialized once in the gunicorn
+# master and the workers are forked from it, see gunicorn.conf.py. Preload is ignored for
+# the gevent worker, which must patch threading before the app is imported. Set
+# DB_CREATE_SCHEMA to false when the tables are created by "flask create-db" as a release
+# step instead.
+DB_CREATE_SCHEMA = os.getenv("DB_CREATE_SCHEMA", "true").lower() == "true"
+GUNICORN_WORKERS = int(os.getenv("GUNICORN_WORKERS", str(os.cpu_count() or 1)))
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "1"))
+GUNICORN_WORKER_CLASS = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+GUNICORN_PRELOAD = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# Connection pool, per worker process. By default the DB_MAX_CONNECTIONS the workers may
+# open together are shared between them, at most 5 + 10 per worker, so that
+# GUNICORN_WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) stays below the max_connections
+# of Postgres (100 by default) up to 45 workers. The engine options are built from these
+# in Recommendation.init_db() once the final database URI is known, the
+# other DB_POOL_* settings are above.
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "90"))
+_worker_connections = max(2, min(15, DB_MAX_CONNECTIONS // GUNICORN_WORKERS))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(min(5, _worker_connections // 3 or 1))))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", str(_worker_connections - DB_POOL_SIZE)))
+
+# Defer the schema check to the first request so a fresh worker is ready sooner.
+# The Swagger spec is always built on the first request for /api/swagger.json.
+LAZY_STARTUP = os.getenv("LAZY_STARTUP", "false").lower() == "true"
+
+# Logging. With LOG_QUEUE_ENABLED log records are written by a background thread
+# instead of the request thread, LOG_INFO_SAMPLE_RATE is the share of requests
+# whose INFO lines are kept, warnings and errors are always kept.
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "false").lower() == "true"
+LOG_INFO_SAMPLE_RATE = float(os.getenv("LOG_INFO_SAMPLE_RATE", "1.0"))
+
+# Prometheus metrics at /metrics. Under gunicorn the workers share their samples
+# through files in METRICS_MULTIPROC_DIR, which is emptied when gunicorn starts.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "/tmp/recommendations-metrics")
+
+# Request profiling. Requests sending X-Profile-Token: PROFILE_TOKEN, and a
+# PROFILE_SAMPLE_RATE share of all requests, are profiled with their SQL statements.
+# The latest PROFILE_MAX_FILES profiles are kept in PROFILE_DIR.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/recommendations-profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+
+# In-memory graph for the expanded (multi-hop) recommendations. Each worker loads it on
+# first use and picks up the writes of the other workers every GRAPH_REFRESH_SECONDS.
+GRAPH_REFRESH_SECONDS = float(os.getenv("GRAPH_REFRESH_SECONDS", "5"))
+GRAPH_COMPACT_THRESHOLD = int(os.getenv("GRAPH_COMPACT_THRESHOLD", "10000"))
+# Version bumps reread behind the last one seen, for the transactions that commit late
+GRAPH_SEQUENCE_MARGIN = int(os.getenv("GRAPH_SEQUENCE_MARGIN", "10000"))
+GRAPH_MAX_DEPTH = int(os.getenv("GRAPH_MAX_DEPTH", "3"))
+GRAPH_LIMIT_DEFAULT = int(os.getenv("GRAPH_LIMIT_DEFAULT", "20"))
+GRAPH_LIMIT_MAX = int(os.getenv("GRAPH_LIMIT_MAX", "200"))
+
+# Memory-mapped snapshot serving the single and group reads, published by
+# "flask build-snapshot". Empty disables it, workers look for a new one every
+# SNAPSHOT_CHECK_SECONDS.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+SNAPSHOT_CHECK_SECONDS = float(os.getenv("SNAPSHOT_CHECK_SECONDS", "5"))
+
+# GO_TOGETHER miner ("flask mine-baskets"). Counting runs on MINE_WORKERS processes
+# and spills its counts to disk to stay within MINE_MEMORY_MB.
+MINE_WORKERS = int(os.getenv("MINE_WORKERS", str(os.cpu_count() or 1)))
+MINE_MEMORY_MB = int(os.getenv("MINE_MEMORY_MB", "512"))
+MINE_TOP_K = int(os.getenv("MINE_TOP_K", "10"))
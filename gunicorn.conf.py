@@ -0,0 +1,61 @@
+"""
+Gunicorn configuration
+
+Worker, thread and preload settings come from config.py (GUNICORN_* environment
+variables). Preload is turned off for the gevent worker: the app would be imported
+before gevent monkey-patches the worker, leaving its threading locks unpatched.
+With preload the app is imported once in the master, which creates
+the schema once; the master then drops its database connections before the
+workers are forked so no two processes share a socket, and every worker opens
+its own pool.
+
+Sessions are scoped to the thread, or to the greenlet for gevent, and removed
+by a teardown_request handler at the end of every request. The app context
+init_db() leaves pushed means Flask-SQLAlchemy's own teardown_appcontext does
+not run for requests on the main thread, which is where the sync worker
+serves them.
+"""
+import os
+import sys
+import glob
+import config as app_config  # "config" is itself a gunicorn setting
+
+if app_config.METRICS_ENABLED:
+    # must be set before the app is loaded, the workers then share their samples through
+    # this directory. The samples of a previous run are dropped.
+    os.environ.setdefault("prometheus_multiproc_dir", app_config.METRICS_MULTIPROC_DIR)
+    os.makedirs(os.environ["prometheus_multiproc_dir"], exist_ok=True)
+    for path in glob.glob(os.path.join(os.environ["prometheus_multiproc_dir"], "*.db")):
+        os.remove(path)
+
+workers = app_config.GUNICORN_WORKERS
+threads = app_config.GUNICORN_THREADS
+worker_class = app_config.GUNICORN_WORKER_CLASS
+# gevent patches threading in each worker, a preloaded app would keep the unpatched locks
+preload_app = app_config.GUNICORN_PRELOAD and worker_class != "gevent"
+
+
+def when_ready(server):
+    """ Runs in the master before the workers are forked """
+    if "service" in sys.modules:  # the app was preloaded
+        sys.modules["service"].dispose_engine()
+        server.log.info("Closed the master's database connections before forking")
+
+
+def post_fork(server, worker):
+    """ Runs in each worker right after it is forked """
+    if worker_class == "gevent":
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()  # make psycopg2 yield to other greenlets while waiting on Postgres
+        except ImportError:
+            server.log.warning("psycogreen is not installed, database calls will block the gevent worker")
+    if "service" in sys.modules:
+        sys.modules["service"].dispose_engine()
+
+
+def child_exit(server, worker):
+    """ Runs in the master when a worker exits """
+    if os.environ.get("prometheus_multiproc_dir"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
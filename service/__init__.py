@@ -4,41 +4,73 @@ Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
+import time
+
+
+class StartupTimer:
+    """ Records how long each phase of the startup takes """
+
+    def __init__(self):
+        self.phases = []
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        """ Ends the current phase under the given name """
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def __str__(self):
+        return " ".join("{}={:.3f}s".format(phase, seconds) for phase, seconds in self.phases)
+
+
+startup_timer = StartupTimer()
+
 import os
 import sys
 import logging
 from flask import Flask
+import flask_restx
+import flask_sqlalchemy
+startup_timer.mark("imports")
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object("config")
+startup_timer.mark("app_config")
 
 # Import the rutes After the Flask app is created
-from service import routes, models
+from service import routes, models, commands, logs
+startup_timer.mark("api_registration")
 
 # Set up logging for production
 if __name__ != "__main__":
     gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    # Make all log formats consistent, optionally written by a background thread
+    logs.configure_logging(app, gunicorn_logger.handlers, gunicorn_logger.level)
     app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
 app.logger.info("  M Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
+startup_timer.mark("logging")
+
 try:
-    routes.init_db()  # make our sqlalchemy tables
+    routes.init_db()  # make our sqlalchemy tables, deferred to the first request with LAZY_STARTUP
 except Exception as error:
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
     sys.exit(4)
+startup_timer.mark("db_init")
+
+app.logger.info("Service inititalized in %.3fs: %s", startup_timer.total, startup_timer)
+
 
-app.logger.info("Service inititalized!")
+def dispose_engine():
+    """ Closes the pooled database connections so a forked process never shares them """
+    models.db.get_engine(app).dispose()
@@ -0,0 +1,89 @@
+"""
+In-process read-through cache
+
+A bounded least recently used cache whose entries expire after a fixed time
+to live. Each worker has its own cache: writes made through the model
+invalidate the local entries, the readers that know the current version of
+a product skip the entries cached under an older one.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+# Returned by get() on a miss, None is a valid cached value
+MISSING = object()
+
+
+class LRUCache:
+    """ A thread safe LRU cache with a time to live and hit/miss/eviction counters """
+
+    def __init__(self, maxsize=10000, ttl=30.0, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=MISSING, valid=None):
+        """
+        Returns the value cached for key, or default if it is missing or expired
+
+        A value for which valid(value) is false is stale, it is dropped and counted as a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if valid is not None and not valid(value):
+                    del self._entries[key]
+                elif expires > self._timer():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                else:
+                    del self._entries[key]
+                    self.expirations += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """ Caches value for key, evicting the least recently used entries when full """
+        with self._lock:
+            self._entries[key] = (self._timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        """ Removes the given keys from the cache """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the size and counters of the cache as a dictionary """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,81 @@
+"""
+Flask CLI commands
+
+Run them with FLASK_APP=service:app, e.g.
+  flask create-db
+  flask build-snapshot
+  flask mine-baskets orders.csv
+  flask import-recommendations recommendations.ndjson
+"""
+import time
+import click
+from service.models import create_tables
+from service.snapshot import build_snapshot
+from service.cooccurrence import mine
+from service.importer import import_file
+from . import app
+
+
+@app.cli.command("create-db")
+def create_db():
+    """ Creates the database tables that do not exist yet, and the indexes missing from the existing ones """
+    create_tables()
+    click.echo("Database tables created")
+
+
+@app.cli.command("build-snapshot")
+@click.option("--path", help="file to publish the snapshot to, SNAPSHOT_PATH by default")
+def build_snapshot_command(path):
+    """ Publishes a memory-mapped snapshot of the Recommendations for the workers to serve reads from """
+    path = path or app.config["SNAPSHOT_PATH"]
+    if not path:
+        raise click.UsageError("Set SNAPSHOT_PATH or pass --path")
+    start = time.perf_counter()
+    products, edges = build_snapshot(path, app.config["EXPORT_CHUNK_SIZE"])
+    click.echo("Published snapshot of {} products and {} recommendations to {} in {:.1f}s".format(
+        products, edges, path, time.perf_counter() - start))
+
+
+@app.cli.command("mine-baskets")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--workers", type=int, help="processes counting the baskets, MINE_WORKERS by default")
+@click.option("--memory-mb", type=int, help="memory budget of the counts, MINE_MEMORY_MB by default")
+@click.option("--top-k", type=int, help="pairs kept per product, MINE_TOP_K by default")
+@click.option("--min-count", type=int, default=2, show_default=True, help="baskets a pair must be found in")
+@click.option("--min-support", type=float, default=0.0, show_default=True, help="share of baskets a pair must be found in")
+@click.option("--min-lift", type=float, default=1.0, show_default=True, help="lift a pair must be above")
+@click.option("--max-basket-size", type=int, default=100, show_default=True, help="larger baskets are skipped")
+def mine_baskets(path, workers, memory_mb, top_k, min_count, min_support, min_lift, max_basket_size):
+    """ Creates GO_TOGETHER Recommendations from the products bought together in a CSV or NDJSON basket file """
+    start = time.perf_counter()
+    baskets, found, created = mine(
+        path, workers=workers or app.config["MINE_WORKERS"], memory_mb=memory_mb or app.config["MINE_MEMORY_MB"],
+        top_k=top_k or app.config["MINE_TOP_K"], min_count=min_count, min_support=min_support, min_lift=min_lift,
+        max_basket_size=max_basket_size,
+    )
+    click.echo("Mined {} GO_TOGETHER pairs from {} baskets, created {} new recommendations in {:.1f}s".format(
+        found, baskets, created, time.perf_counter() - start))
+
+
+@app.cli.command("import-recommendations")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--rejects", help="file the rejected records are written to, PATH.rejects by default")
+@click.option("--chunk-size", type=int, help="records written per transaction, IMPORT_CHUNK_SIZE by default")
+@click.option("--on-conflict", type=click.Choice(["update", "skip"]), default="update", show_default=True,
+              help="update the relationship and likes of existing pairs, or keep them")
+def import_recommendations(path, rejects, chunk_size, on_conflict):
+    """ Loads the Recommendations of a CSV or NDJSON file, e.g. one written by the export """
+    rejects = rejects or path + ".rejects"
+    last = [0.0]
+
+    def progress(stats):
+        if stats["seconds"] - last[0] >= 1:
+            last[0] = stats["seconds"]
+            click.echo("{read} records read, {rejected} rejected, {rate:.0f} records/s".format(
+                rate=stats["read"] / stats["seconds"], **stats), err=True)
+
+    stats = import_file(path, rejects, chunk_size or app.config["IMPORT_CHUNK_SIZE"], on_conflict, progress)
+    click.echo("Imported {written} recommendations from {read} records in {seconds:.1f}s ({rate:.0f} records/s)".format(
+        rate=stats["read"] / stats["seconds"] if stats["seconds"] else 0, **stats))
+    if stats["rejected"]:
+        click.echo("Rejected {} records, see {}".format(stats["rejected"], rejects))
@@ -0,0 +1,293 @@
+"""
+GO_TOGETHER miner
+
+Derives GO_TOGETHER Recommendations from order baskets. A basket file is
+either a CSV with order_id and product_id columns, the lines of an order
+being next to each other as in an order line export, or NDJSON with one
+basket per line, {"products": [1, 2, 3]} or a plain array.
+
+The baskets are read in chunks that the worker processes turn into
+co-occurrence counts with vectorized NumPy operations: every ordered pair of
+distinct products of a basket becomes one int64 key, source << 32 | target,
+and the keys are counted with np.unique. Pairs are split into partitions by
+source product. Once the counts held in memory reach half of the memory
+budget each partition is merged and spilled to disk as a sorted run. Every
+partition is then reduced on its own by merging its runs a block at a time,
+the keys being sorted by source a block holds the whole pairs of its
+sources, so a reduce only keeps a block of each run in memory however many
+pairs were spilled.
+
+For a pair of products a and b found in n(a, b) of the N baskets
+  support = n(a, b) / N
+  lift    = n(a, b) * N / (n(a) * n(b))
+a lift above 1 means the products are bought together more often than
+chance. Each product keeps its top_k pairs by lift.
+"""
+import os
+import csv
+import json
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from itertools import groupby
+import numpy as np
+from service.models import Recommendation
+
+logger = logging.getLogger("flask.app")
+
+# Product ids are packed two to an int64 key
+MAX_PRODUCT_ID = 2 ** 31 - 1
+# Bytes a pair takes while a chunk is counted: its positions, key, partition and sort buffers
+BYTES_PER_PAIR = 48
+# Bytes a counted pair takes once merged, its key and its count
+BYTES_PER_COUNT = 16
+
+
+######################################################################
+# READING BASKETS
+######################################################################
+def read_baskets(path, max_basket_size=100):
+    """ Yields the distinct product ids of every basket of a CSV or NDJSON file """
+    with open(path, newline="") as basket_file:
+        if path.endswith(".csv"):
+            lines = ((row["order_id"], row["product_id"]) for row in csv.DictReader(basket_file))
+            baskets = ([product_id for _, product_id in order] for _, order in groupby(lines, key=lambda line: line[0]))
+        else:
+            baskets = (_ndjson_basket(line) for line in basket_file if line.strip())
+        for basket in baskets:
+            try:
+                products = sorted(set(int(product_id) for product_id in basket))
+            except (TypeError, ValueError):
+                products = None
+            if not products or products[0] < 0 or products[-1] > MAX_PRODUCT_ID:
+                logger.warning("Skipping a basket with invalid product ids: %s", basket)
+                continue
+            # huge baskets (wholesale orders) add n^2 pairs and say little about each product
+            if len(products) <= max_basket_size:
+                yield products
+
+
+def _ndjson_basket(line):
+    basket = json.loads(line)
+    return basket["products"] if isinstance(basket, dict) else basket
+
+
+def chunk_baskets(baskets, max_pairs):
+    """ Groups baskets into (products, lengths) arrays of at most max_pairs pairs, or one larger basket """
+    products, lengths, pairs = [], [], 0
+    for basket in baskets:
+        size = len(basket)
+        if lengths and pairs + size * (size - 1) > max_pairs:
+            yield np.array(products, dtype=np.int64), np.array(lengths, dtype=np.int64)
+            products, lengths, pairs = [], [], 0
+        products.extend(basket)
+        lengths.append(size)
+        pairs += size * (size - 1)
+    if lengths:
+        yield np.array(products, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+
+######################################################################
+# COUNTING
+######################################################################
+def count_chunk(products, lengths, partitions):
+    """
+    Counts the baskets of a chunk
+
+    products holds the product ids of the baskets end to end, lengths the size of
+    each basket. Returns the basket count, the product ids with the number of
+    baskets holding them, and for every partition the sorted pair keys with
+    their counts.
+    """
+    items, item_counts = np.unique(products, return_counts=True)
+    starts = np.cumsum(lengths) - lengths
+    # every position is paired with every position of its basket, itself included
+    repeats = np.repeat(lengths, lengths)
+    left = np.repeat(np.arange(len(products)), repeats)
+    partner_starts = np.repeat(np.repeat(starts, lengths), repeats)
+    within = np.arange(len(left)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    right = partner_starts + within
+    keep = left != right
+    sources, targets = products[left[keep]], products[right[keep]]
+    keys = (sources << 32) | targets
+    owners = sources % partitions
+    counts = []
+    for partition in range(partitions):
+        counts.append(np.unique(keys[owners == partition], return_counts=True))
+    return len(lengths), (items, item_counts), counts
+
+
+def merge_counts(parts):
+    """ Adds up (keys, counts) arrays into one sorted (keys, counts) pair """
+    parts = [part for part in parts if len(part[0])]
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if len(parts) == 1:
+        return parts[0]
+    keys, inverse = np.unique(np.concatenate([part[0] for part in parts]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([part[1] for part in parts]), minlength=len(keys))
+    return keys, counts.astype(np.int64)
+
+
+def merge_runs(paths, block):
+    """
+    Yields the merged (keys, counts) of the sorted run files at paths, source product by source product
+
+    At most block keys are read from each run at a time, more only when the
+    pairs of a single source do not fit in a block.
+    """
+    runs = [[run, 0] for run in (np.load(path, mmap_mode="r") for path in paths) if run.shape[1]]
+    while runs:
+        limits = [int(run[0, start + block - 1]) for run, start in runs if start + block < run.shape[1]]
+        end = None
+        if limits:
+            # the pairs of a source must not be split over two blocks
+            source = min(limits) >> 32
+            if any(run[0, start] < source << 32 for run, start in runs):
+                end = source << 32
+            elif source < MAX_PRODUCT_ID:
+                end = (source + 1) << 32
+        parts = []
+        for cursor in runs:
+            run, start = cursor
+            stop = run.shape[1] if end is None else start + int(np.searchsorted(run[0, start:], end))
+            parts.append((np.array(run[0, start:stop]), np.array(run[1, start:stop])))
+            cursor[1] = stop
+        runs = [[run, start] for run, start in runs if start < run.shape[1]]
+        yield merge_counts(parts)
+
+
+def top_pairs(keys, counts, items, item_counts, baskets, min_count=2, min_support=0.0, min_lift=1.0, top_k=10):
+    """ Returns the (sources, targets, counts, lifts) of the top_k pairs of every source by lift """
+    keep = (counts >= min_count) & (counts >= min_support * baskets)
+    keys, counts = keys[keep], counts[keep]
+    sources, targets = keys >> 32, keys & 0xFFFFFFFF
+    source_counts = item_counts[np.searchsorted(items, sources)]
+    target_counts = item_counts[np.searchsorted(items, targets)]
+    lifts = counts * float(baskets) / (source_counts * target_counts)
+    keep = lifts > min_lift
+    sources, targets, counts, lifts = sources[keep], targets[keep], counts[keep], lifts[keep]
+    # best lift first within each source, the keys being sorted ties stay in target order
+    order = np.lexsort((-lifts, sources))
+    sources, targets, counts, lifts = sources[order], targets[order], counts[order], lifts[order]
+    starts = np.flatnonzero(np.diff(sources, prepend=-1))
+    ranks = np.arange(len(sources)) - np.repeat(starts, np.diff(starts, append=len(sources)))
+    keep = ranks < top_k
+    return sources[keep], targets[keep], counts[keep], lifts[keep]
+
+
+class CooccurrenceMiner:
+    """ Counts product co-occurrences over many processes within a memory budget """
+
+    def __init__(self, workers=1, memory_mb=512, partitions=None, directory=None):
+        self.workers = max(1, workers)
+        budget = memory_mb * 1024 * 1024
+        # half of the budget goes to the chunks being counted, half to the counts kept before a spill
+        self.max_pairs = max(1, budget // 2 // self.workers // BYTES_PER_PAIR)
+        self.max_counts = max(1, budget // 2 // BYTES_PER_COUNT)
+        self.partitions = partitions or max(1, self.workers)
+        self.directory = tempfile.mkdtemp(prefix="cooccurrence-", dir=directory)
+        self.baskets = 0
+        self.items = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self.pending = [[] for _ in range(self.partitions)]
+        self.pending_counts = 0
+        self.runs = 0
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _add(self, result):
+        baskets, items, counts = result
+        self.baskets += baskets
+        self.items = merge_counts([self.items, items])
+        for partition, part in enumerate(counts):
+            self.pending[partition].append(part)
+            self.pending_counts += len(part[0])
+        if self.pending_counts >= self.max_counts:
+            self._spill()
+
+    def _spill(self):
+        """ Writes the counts held in memory to one run file per partition """
+        for partition, parts in enumerate(self.pending):
+            keys, counts = merge_counts(parts)
+            np.save(self._run_path(partition, self.runs), np.stack([keys, counts]))
+        self.pending = [[] for _ in range(self.partitions)]
+        self.pending_counts = 0
+        self.runs += 1
+
+    def _run_path(self, partition, run):
+        return os.path.join(self.directory, "{}-{}.npy".format(partition, run))
+
+    def count(self, baskets):
+        """ Counts the baskets of an iterable """
+        chunks = chunk_baskets(baskets, self.max_pairs)
+        if self.workers == 1:
+            for products, lengths in chunks:
+                self._add(count_chunk(products, lengths, self.partitions))
+            return
+        with multiprocessing.Pool(self.workers) as pool:
+            # at most two chunks per worker in flight, Pool.imap would read the whole file ahead
+            pending = []
+            for products, lengths in chunks:
+                pending.append(pool.apply_async(count_chunk, (products, lengths, self.partitions)))
+                if len(pending) >= 2 * self.workers:
+                    self._add(pending.pop(0).get())
+            for result in pending:
+                self._add(result.get())
+
+    def top_pairs(self, **options):
+        """ Yields the (sources, targets, counts, lifts) of the top pairs of each partition """
+        self._spill()
+        items, item_counts = self.items
+        reducers = min(self.workers, self.partitions)
+        # the reducers share the counts a spill holds, a block of each run at a time
+        block = max(1, self.max_counts // reducers // self.runs)
+        arguments = [([self._run_path(partition, run) for run in range(self.runs)],
+                      items, item_counts, self.baskets, block, options) for partition in range(self.partitions)]
+        if self.workers == 1:
+            for args in arguments:
+                yield _reduce_partition(*args)
+            return
+        with multiprocessing.Pool(reducers) as pool:
+            for result in pool.imap(_reduce_partition_args, arguments):
+                yield result
+
+
+def _reduce_partition(paths, items, item_counts, baskets, block, options):
+    found = [top_pairs(keys, counts, items, item_counts, baskets, **options) for keys, counts in merge_runs(paths, block)]
+    if not found:
+        return top_pairs(*merge_counts([]), items, item_counts, baskets, **options)
+    return tuple(np.concatenate(column) for column in zip(*found))
+
+
+def _reduce_partition_args(args):
+    return _reduce_partition(*args)
+
+
+def mine(path, workers=1, memory_mb=512, top_k=10, min_count=2, min_support=0.0, min_lift=1.0,
+         max_basket_size=100, chunk_size=5000):
+    """
+    Mines the basket file at path and creates the GO_TOGETHER Recommendations found
+
+    Pairs that already exist, whatever their relationship, are left as they are.
+    Returns the number of baskets, of pairs found and of Recommendations created.
+    """
+    miner = CooccurrenceMiner(workers, memory_mb)
+    try:
+        miner.count(read_baskets(path, max_basket_size))
+        logger.info("Counted %s baskets of %s products", miner.baskets, len(miner.items[0]))
+        found = created = 0
+        for sources, targets, _, _ in miner.top_pairs(top_k=top_k, min_count=min_count,
+                                                       min_support=min_support, min_lift=min_lift):
+            found += len(sources)
+            for start in range(0, len(sources), chunk_size):
+                results = Recommendation.create_many([
+                    {"product_id": source, "recommendation_product_id": target, "relationship": "GO_TOGETHER"}
+                    for source, target in zip(sources[start:start + chunk_size].tolist(),
+                                              targets[start:start + chunk_size].tolist())
+                ])
+                created += sum(1 for result in results if result["status"] == "created")
+        return miner.baskets, found, created
+    finally:
+        miner.close()
@@ -0,0 +1,216 @@
+"""
+In-memory Recommendation graph
+
+The Recommendations form a directed graph of products whose edges carry a
+relationship and a like count. RecommendationGraph keeps it in compressed
+sparse row (CSR) arrays: the out edges of the product ids[i] are
+targets[indptr[i]:indptr[i + 1]], with their relationship codes and likes
+at the same positions. A breadth first walk over a few hops is then a
+handful of vectorized NumPy operations instead of a recursive SQL query.
+
+The graph follows the writes without being reloaded: every write bumps the
+ProductVersion of its product and stamps it with the next value of a
+sequence, so a refresh only reads the versions stamped since the last value
+it saw, and the out edges of the products whose version changed into an
+overlay that replaces their CSR rows. Sequence values are taken without a
+lock and a transaction can commit after others that took later values, so
+a refresh looks back GRAPH_SEQUENCE_MARGIN values behind the last one seen,
+the versions it already knows being skipped.
+Writes made by this worker are seen by its next query, writes made by other
+workers within GRAPH_REFRESH_SECONDS. Once the overlay holds more than
+GRAPH_COMPACT_THRESHOLD products it is merged into new CSR arrays.
+"""
+import time
+import logging
+import threading
+import numpy as np
+from service.models import db, Recommendation, ProductVersion, Type
+
+logger = logging.getLogger("flask.app")
+
+# Products whose edges are read back per query when refreshing
+REFRESH_CHUNK_SIZE = 500
+EMPTY = np.empty(0, dtype=np.int64)
+
+
+class RecommendationGraph:
+    """ The Recommendation graph in CSR arrays with an overlay of recently written products """
+
+    def __init__(self, refresh_seconds=5.0, compact_threshold=10000, sequence_margin=10000, timer=time.monotonic):
+        self.refresh_seconds = refresh_seconds
+        self.compact_threshold = compact_threshold
+        self.sequence_margin = sequence_margin
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._checked = 0.0
+        self._dirty = set()
+        self._dirty_all = False
+        self.versions = {}
+        self.sequence = 0
+        self.state = (EMPTY, np.zeros(1, dtype=np.int64), EMPTY, EMPTY.astype(np.int8), EMPTY, {})
+
+    ######################################################################
+    # LOADING AND REFRESHING
+    ######################################################################
+    @staticmethod
+    def _edge_arrays(rows):
+        """ Returns the product id, target, code and likes arrays of (product_id, target, relationship, likes) rows """
+        count = len(rows)
+        sources = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+        targets = np.fromiter((row[1] for row in rows), dtype=np.int64, count=count)
+        codes = np.fromiter((row[2].value for row in rows), dtype=np.int8, count=count)
+        likes = np.fromiter((row[3] or 0 for row in rows), dtype=np.int64, count=count)
+        return sources, targets, codes, likes
+
+    def _build(self, sources, targets, codes, likes):
+        """ Builds the CSR arrays from edge arrays sorted by source, with an empty overlay """
+        ids, counts = np.unique(sources, return_counts=True)
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        # swapped as one tuple so a concurrent query never mixes two versions of the graph
+        self.state = (ids, indptr, targets, codes, likes, {})
+
+    def load(self):
+        """ Reads the whole graph and the product versions from the database """
+        start = time.perf_counter()
+        changes = ProductVersion.changed_since(-1)
+        rows = Recommendation.rows().order_by(Recommendation.product_id, Recommendation.recommendation_product_id).all()
+        self._build(*self._edge_arrays(rows))
+        self.versions = {product_id: version for product_id, version, _ in changes}
+        self.sequence = max((sequence for _, _, sequence in changes), default=0)
+        self._loaded = True
+        self._checked = self._timer()
+        logger.info("Loaded recommendation graph of %s products and %s edges in %.3fs",
+                    len(self.state[0]), len(rows), time.perf_counter() - start)
+
+    def mark_dirty(self, product_id=None):
+        """ Rereads the edges of product_id, or the whole graph, before the next query """
+        with self._lock:
+            if product_id is None:
+                self._dirty_all = True
+            else:
+                self._dirty.add(product_id)
+
+    def refresh(self):
+        """ Loads the graph, or the products written since the last refresh, when needed """
+        with self._lock:
+            now = self._timer()
+            if not self._loaded or self._dirty_all:
+                self._dirty_all = False
+                self._dirty.clear()
+                self.load()
+                return
+            if not self._dirty and now - self._checked < self.refresh_seconds:
+                return
+            changed, self._dirty = set(self._dirty), set()
+            if now - self._checked >= self.refresh_seconds:
+                for product_id, version, sequence in ProductVersion.changed_since(self.sequence - self.sequence_margin):
+                    if self.versions.get(product_id) != version:
+                        changed.add(product_id)
+                        self.versions[product_id] = version
+                    self.sequence = max(self.sequence, sequence)
+                self._checked = now
+            if len(changed) > self.compact_threshold:
+                self.load()
+                return
+            self._update(changed)
+
+    def _update(self, product_ids):
+        """ Replaces the out edges of the given products in the overlay """
+        if not product_ids:
+            return
+        overlay = dict(self.state[5])
+        product_ids = sorted(product_ids)
+        for start in range(0, len(product_ids), REFRESH_CHUNK_SIZE):
+            chunk = product_ids[start:start + REFRESH_CHUNK_SIZE]
+            rows = Recommendation.rows().filter(Recommendation.product_id.in_(chunk)).order_by(
+                Recommendation.product_id, Recommendation.recommendation_product_id).all()
+            sources, targets, codes, likes = self._edge_arrays(rows)
+            for product_id in chunk:
+                first, last = np.searchsorted(sources, [product_id, product_id + 1])
+                overlay[product_id] = (targets[first:last], codes[first:last], likes[first:last])
+        self.state = self.state[:5] + (overlay,)
+        if len(overlay) > self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        """ Merges the overlay into new CSR arrays """
+        ids, indptr, targets, codes, likes, overlay = self.state
+        sources = np.repeat(ids, np.diff(indptr))
+        keep = ~np.isin(sources, np.fromiter(overlay, dtype=np.int64))
+        parts = [(sources[keep], targets[keep], codes[keep], likes[keep])]
+        for product_id, (edge_targets, edge_codes, edge_likes) in overlay.items():
+            parts.append((np.full(len(edge_targets), product_id, dtype=np.int64), edge_targets, edge_codes, edge_likes))
+        sources = np.concatenate([part[0] for part in parts])
+        order = np.argsort(sources, kind="stable")
+        self._build(*(np.concatenate([part[i] for part in parts])[order] for i in range(4)))
+
+    ######################################################################
+    # QUERIES
+    ######################################################################
+    def edges(self, product_ids):
+        """ Returns the (sources, targets, codes, likes) arrays of the out edges of product_ids """
+        ids, indptr, targets, codes, likes, overlay = self.state
+        if overlay:
+            overridden = np.isin(product_ids, np.fromiter(overlay, dtype=np.int64))
+            extra = [(product_id,) + overlay[product_id] for product_id in product_ids[overridden].tolist()]
+            product_ids = product_ids[~overridden]
+        else:
+            extra = []
+        positions = np.searchsorted(ids, product_ids)
+        present = positions < len(ids)
+        present[present] = ids[positions[present]] == product_ids[present]
+        rows = positions[present]
+        starts, counts = indptr[rows], indptr[rows + 1] - indptr[rows]
+        # the edge positions of every row, laid end to end
+        index = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        sources = np.repeat(product_ids[present], counts)
+        result = [sources, targets[index], codes[index], likes[index]]
+        for product_id, edge_targets, edge_codes, edge_likes in extra:
+            result[0] = np.concatenate([result[0], np.full(len(edge_targets), product_id, dtype=np.int64)])
+            result[1] = np.concatenate([result[1], edge_targets])
+            result[2] = np.concatenate([result[2], edge_codes])
+            result[3] = np.concatenate([result[3], edge_likes])
+        return result
+
+    def expand(self, product_id, depth=2, type=None, limit=50):
+        """
+        Returns the products reachable from product_id in up to depth hops, best scored first
+
+        Every path of h hops to a product adds (1 + the likes of its last edge) / h to
+        the product's score, so products reached by many, well liked and short paths
+        come first. Each result holds the product id, the fewest hops it takes, the
+        number of paths and the likes of their last edges.
+        """
+        self.refresh()
+        code = Type[type].value if type else None
+        frontier, weights = np.array([product_id], dtype=np.int64), np.ones(1, dtype=np.int64)
+        found = {}
+        for hops in range(1, depth + 1):
+            sources, targets, codes, likes = self.edges(frontier)
+            if code is not None:
+                keep = codes == code
+                sources, targets, likes = sources[keep], targets[keep], likes[keep]
+            # number of paths reaching each edge's source at this hop
+            paths = weights[np.searchsorted(frontier, sources)]
+            keep = targets != product_id
+            targets, likes, paths = targets[keep], likes[keep], paths[keep]
+            if not len(targets):
+                break
+            frontier, inverse = np.unique(targets, return_inverse=True)
+            weights = np.bincount(inverse, weights=paths).astype(np.int64)
+            liked = np.bincount(inverse, weights=paths * likes)
+            scores = np.bincount(inverse, weights=paths * (1 + likes)) / hops
+            for target, path_count, like_count, score in zip(frontier.tolist(), weights.tolist(),
+                                                             liked.tolist(), scores.tolist()):
+                result = found.get(target)
+                if result is None:
+                    found[target] = {"product_id": target, "depth": hops, "paths": path_count,
+                                     "likes": int(like_count), "score": score}
+                else:
+                    result["paths"] += path_count
+                    result["likes"] += int(like_count)
+                    result["score"] += score
+        ranked = sorted(found.values(), key=lambda result: (-result["score"], result["product_id"]))
+        return ranked[:limit]
@@ -0,0 +1,193 @@
+"""
+Bulk import of Recommendations
+
+import_file() streams a CSV file with product_id, recommendation_product_id,
+relationship and optional likes columns, or NDJSON with one Recommendation
+per line as written by GET /recommendations/export. Records are validated
+like the REST API validates them and written in chunks, every chunk in its
+own transaction, so memory does not depend on the size of the file and an
+interrupted import can simply be run again.
+
+On Postgres a chunk is copied into a temporary staging table with COPY and
+merged into the recommendation table with one INSERT ... SELECT ... ON
+CONFLICT statement. Other databases get a chunked executemany of an
+INSERT ... ON CONFLICT. A record without likes creates its pair with 0
+likes and leaves the likes of a pair it updates as they are. Rejected records are written to a reject file as
+NDJSON with their line number, the error and the original line.
+"""
+import io
+import csv
+import json
+import time
+import logging
+from sqlalchemy import text
+from service.models import db, Recommendation, ProductVersion, DataValidationError, MAX_ID
+
+logger = logging.getLogger("flask.app")
+
+STAGING_TABLE = "recommendation_import"
+COLUMNS = ("product_id", "recommendation_product_id", "relationship", "likes")
+ON_CONFLICT = {
+    "update": "DO UPDATE SET relationship = excluded.relationship, likes = excluded.likes",
+    "skip": "DO NOTHING",
+}
+# For the records without likes
+ON_CONFLICT_KEEP_LIKES = {
+    "update": "DO UPDATE SET relationship = excluded.relationship",
+    "skip": "DO NOTHING",
+}
+
+
+def read_records(path):
+    """ Yields the line number, the original line and the parsed record of every line of a CSV or NDJSON file """
+    with open(path, newline="") as import_file:
+        if path.endswith(".csv"):
+            reader = csv.DictReader(import_file)
+            for record in reader:
+                line = ",".join(record.get(column) or "" for column in reader.fieldnames)
+                yield reader.line_num, line, record
+            return
+        for number, line in enumerate(import_file, 1):
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield number, line, record
+
+
+def validate_record(record):
+    """ Returns the row of a CSV or NDJSON record, raising DataValidationError if it is not a valid Recommendation """
+    if not isinstance(record, dict):
+        raise DataValidationError("Invalid Recommendation Model: line is not a record")
+    data = dict(record)
+    for key in ("product_id", "recommendation_product_id", "likes"):
+        if isinstance(data.get(key), str):
+            try:
+                data[key] = int(data[key]) if data[key] else None
+            except ValueError:
+                raise DataValidationError("Invalid Recommendation Model: {} must be an integer".format(key))
+    row = Recommendation.validate(data)
+    # None when absent, an update must not reset the likes of the pair
+    likes = row["likes"] = data.get("likes")
+    if likes is not None:
+        if isinstance(likes, bool) or not isinstance(likes, int) or likes < 0:
+            raise DataValidationError("Invalid Recommendation Model: likes must be a positive integer")
+        if likes > MAX_ID:
+            raise DataValidationError("Invalid Recommendation Model: likes is out of range")
+    return row
+
+
+class Importer:
+    """ Writes chunks of validated rows, with COPY on Postgres and executemany elsewhere """
+
+    def __init__(self, on_conflict="update"):
+        self.on_conflict = ON_CONFLICT[on_conflict]
+        self.on_conflict_keep_likes = ON_CONFLICT_KEEP_LIKES[on_conflict]
+        self.copy = db.engine.dialect.name == "postgresql"
+
+    def write(self, rows):
+        """ Writes a chunk of rows in one transaction, returns the number of rows inserted or updated """
+        # the last record of a key wins, a single statement cannot write the same row twice
+        rows = list({(row["product_id"], row["recommendation_product_id"]): row for row in rows}.values())
+        try:
+            written = self._copy(rows) if self.copy else self._execute_many(rows)
+            product_ids = sorted({row["product_id"] for row in rows})
+            ProductVersion.bump(product_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for product_id in product_ids:
+            Recommendation.invalidate(product_id)
+        return written
+
+    def _execute_many(self, rows):
+        statement = (
+            "INSERT INTO recommendation (product_id, recommendation_product_id, relationship, likes) "
+            "VALUES (:product_id, :recommendation_product_id, :relationship, :likes) "
+            "ON CONFLICT (product_id, recommendation_product_id) "
+        )
+        with_likes = [row for row in rows if row["likes"] is not None]
+        without_likes = [dict(row, likes=0) for row in rows if row["likes"] is None]
+        written = 0
+        for part, on_conflict in ((with_likes, self.on_conflict), (without_likes, self.on_conflict_keep_likes)):
+            if part:
+                result = db.session.execute(text(statement + on_conflict),
+                                            [dict(row, relationship=row["relationship"].name) for row in part])
+                written += result.rowcount
+        return written
+
+    def _copy(self, rows):
+        connection = db.session.connection()
+        # every chunk may get another pooled connection, the table is dropped with the connection
+        # and emptied by every commit
+        connection.execute(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS {} (LIKE recommendation INCLUDING DEFAULTS) "
+            "ON COMMIT DELETE ROWS".format(STAGING_TABLE)
+        )
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row["product_id"], row["recommendation_product_id"], row["relationship"].name, row["likes"]])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(STAGING_TABLE, ", ".join(COLUMNS)), buffer)
+        finally:
+            cursor.close()
+        written = 0
+        # the records without likes were copied with NULL likes
+        for likes, condition, on_conflict in (("likes", "IS NOT NULL", self.on_conflict),
+                                              ("0", "IS NULL", self.on_conflict_keep_likes)):
+            result = connection.execute(
+                "INSERT INTO recommendation ({columns}) "
+                "SELECT product_id, recommendation_product_id, relationship, {likes} FROM {staging} "
+                "WHERE likes {condition} "
+                "ON CONFLICT (product_id, recommendation_product_id) {on_conflict}".format(
+                    columns=", ".join(COLUMNS), likes=likes, staging=STAGING_TABLE,
+                    condition=condition, on_conflict=on_conflict)
+            )
+            written += result.rowcount
+        return written
+
+
+def import_file(path, rejects_path, chunk_size=5000, on_conflict="update", progress=None):
+    """
+    Imports the Recommendations of a CSV or NDJSON file
+
+    Invalid records are written to rejects_path. progress, if given, is called
+    with the statistics after every chunk. Returns the statistics: records
+    read, rows written, records rejected and the elapsed seconds.
+    """
+    importer = Importer(on_conflict)
+    stats = {"read": 0, "written": 0, "rejected": 0, "seconds": 0.0}
+    start = time.perf_counter()
+
+    def flush(rows):
+        stats["written"] += importer.write(rows)
+        stats["seconds"] = time.perf_counter() - start
+        if progress:
+            progress(stats)
+
+    rows = []
+    with open(rejects_path, "w") as rejects:
+        for number, line, record in read_records(path):
+            stats["read"] += 1
+            try:
+                rows.append(validate_record(record))
+            except DataValidationError as error:
+                stats["rejected"] += 1
+                rejects.write(json.dumps({"line": number, "error": str(error), "record": line}) + "\n")
+                continue
+            if len(rows) >= chunk_size:
+                flush(rows)
+                rows = []
+        if rows:
+            flush(rows)
+    stats["seconds"] = time.perf_counter() - start
+    logger.info("Imported %s of %s records from %s in %.1fs, %s rejected",
+                stats["written"], stats["read"], path, stats["seconds"], stats["rejected"])
+    return stats
@@ -0,0 +1,89 @@
+"""
+Write-behind buffer for likes
+
+When LIKE_WRITE_BEHIND is enabled each worker adds likes up in memory and a
+background thread flushes the totals to the database in one batched UPDATE
+every LIKE_FLUSH_INTERVAL_MS milliseconds, or as soon as LIKE_FLUSH_MAX_PENDING
+likes are waiting, whichever comes first. A like storm on one pair then costs
+a single statement per flush instead of one commit per click.
+
+Likes still in the buffer are lost if the worker is killed before a flush.
+"""
+import os
+import atexit
+import logging
+import threading
+from service.models import db, Recommendation
+
+logger = logging.getLogger("flask.app")
+
+
+class LikeBuffer:
+    """ Aggregates likes per (product_id, recommendation_product_id) and flushes them in batches """
+
+    def __init__(self, app, interval_ms=100, max_pending=1000):
+        self.app = app
+        self.interval = interval_ms / 1000.0
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._deltas = {}
+        self._pending = 0
+        self._pid = None
+
+    def add(self, product_id, recommendation_product_id, count=1):
+        """ Buffers count likes and returns the number of likes waiting for the pair """
+        self._start()
+        key = (product_id, recommendation_product_id)
+        with self._lock:
+            self._deltas[key] = self._deltas.get(key, 0) + count
+            self._pending += count
+            waiting = self._deltas[key]
+            full = self._pending >= self.max_pending
+        if full:
+            self._wakeup.set()
+        return waiting
+
+    def flush(self):
+        """ Writes all buffered likes to the database, returns the number of pairs written """
+        with self._lock:
+            deltas, self._deltas, self._pending = self._deltas, {}, 0
+        if not deltas:
+            return 0
+        try:
+            with self.app.app_context():
+                try:
+                    Recommendation.add_likes(deltas)
+                finally:
+                    db.session.remove()
+        except Exception:
+            # put the likes back so the next flush can retry them
+            with self._lock:
+                for key, delta in deltas.items():
+                    self._deltas[key] = self._deltas.get(key, 0) + delta
+                    self._pending += delta
+            raise
+        return len(deltas)
+
+    def _start(self):
+        """ Starts the flusher thread once per process, threads do not survive a fork """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # anything buffered before a fork belongs to the parent
+            self._deltas, self._pending = {}, 0
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="like-flusher", daemon=True).start()
+            atexit.register(self.flush)
+
+    def _run(self):
+        """ Flushes the buffer every interval or when it fills up """
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as error:  # keep the flusher alive, the likes are retried
+                logger.error("Could not flush likes: %s", error)
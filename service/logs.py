@@ -0,0 +1,119 @@
+"""
+Request logging that stays off the hot path
+
+With LOG_QUEUE_ENABLED the request threads only put log records on an
+in-memory queue, a listener thread formats them and writes them to the
+gunicorn handlers. LOG_INFO_SAMPLE_RATE keeps that share of the requests'
+INFO and DEBUG lines, warnings and errors are always written. Extra
+key/value fields are passed with kv() and only formatted when the record is
+written:
+
+  app.logger.info("Request to like a recommendation", extra=kv(product_id=1))
+"""
+import os
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from flask import request, has_request_context
+
+
+def kv(**fields):
+    """ Returns the extra argument that attaches key/value fields to a log record """
+    return {"fields": fields}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """ A Formatter that appends the key/value fields of a record to its message """
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if not fields:
+            return message
+        return message + " " + " ".join("{}={}".format(key, value) for key, value in fields.items())
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps the INFO and DEBUG records of only a sample of the requests
+
+    The decision is made once per request so a sampled request keeps all of
+    its lines. Records logged outside of a request are never dropped.
+    """
+
+    def __init__(self, rate=1.0, random=random.random):
+        super().__init__()
+        self.rate = rate
+        self._random = random
+
+    def filter(self, record):
+        if record.levelno > logging.INFO or self.rate >= 1.0 or not has_request_context():
+            return True
+        # kept in the WSGI environ, g can outlive the request when an app context was already pushed
+        sampled = request.environ.get("service.log_sampled")
+        if sampled is None:
+            sampled = request.environ["service.log_sampled"] = self._random() < self.rate
+        return sampled
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """ Queues records for a listener thread that writes them to the given handlers """
+
+    def __init__(self, handlers):
+        super().__init__(queue.Queue())
+        self.handlers = list(handlers)
+        self.listener = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def prepare(self, record):
+        # the listener runs in this process, so the message is formatted there instead of here
+        return record
+
+    def emit(self, record):
+        self._start()
+        super().emit(record)
+
+    def _start(self):
+        """ Starts the listener thread once per process, threads do not survive a fork """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # records queued before a fork belong to the parent
+            self.queue = queue.Queue()
+            self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """ Writes the queued records and stops the listener of this process """
+        with self._lock:
+            if self.listener is not None and self._pid == os.getpid():
+                self.listener.stop()
+            self.listener, self._pid = None, None
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+def configure_logging(app, handlers, level):
+    """ Sends the app's log records to handlers as configured by the LOG_* settings """
+    formatter = KeyValueFormatter(
+        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+    )
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if app.config["LOG_QUEUE_ENABLED"]:
+        handlers = [BackgroundQueueHandler(handlers)]
+    app.logger.handlers = list(handlers)
+    app.logger.setLevel(level)
+    app.logger.propagate = False
+    if app.config["LOG_INFO_SAMPLE_RATE"] < 1.0:
+        app.logger.addFilter(SamplingFilter(app.config["LOG_INFO_SAMPLE_RATE"]))
@@ -0,0 +1,96 @@
+"""
+Prometheus metrics
+
+Request counts and latencies per route and status, database queries per
+request, cache lookups and written likes, exposed at /metrics in the
+Prometheus text format.
+
+Under gunicorn every worker writes its samples to files in the
+prometheus_multiproc_dir directory set up by gunicorn.conf.py, and /metrics
+adds up the samples of all workers whichever worker serves it.
+"""
+import os
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by route, method and status", ["route", "method", "status"]
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route and method", ["route", "method"],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+DB_QUERIES = Histogram(
+    "db_queries_per_request", "Database statements executed per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+DB_LATENCY = Histogram(
+    "db_query_duration_seconds_per_request", "Time spent in database statements per request", ["route"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5),
+)
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total", "Read-through cache lookups by result", ["result"]
+)
+LIKES_WRITTEN = Counter(
+    "likes_written_total", "Likes written to the database by mode", ["mode"]
+)
+
+
+def registry():
+    """ Returns the registry to collect from, the samples of all workers in multi-process mode """
+    if "prometheus_multiproc_dir" not in os.environ:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def latest():
+    """ Returns the metrics in the Prometheus text format and their content type """
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def route_label():
+    """ Returns the URL rule of the current request, which keeps the number of label values bounded """
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+
+def finish_request(response):
+    if "metrics_start" not in g:
+        return response
+    route = route_label()
+    REQUESTS.labels(route, request.method, response.status_code).inc()
+    REQUEST_LATENCY.labels(route, request.method).observe(time.perf_counter() - g.metrics_start)
+    DB_QUERIES.labels(route).observe(g.db_queries)
+    DB_LATENCY.labels(route).observe(g.db_seconds)
+    return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["metrics_query_start"].pop()
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_seconds += time.perf_counter() - started
+
+
+def init_metrics(app):
+    """ Instruments the app's requests and every engine's statements """
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
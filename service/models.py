@@ -6,12 +6,43 @@ All of the models are stored in this module
 import logging
 from enum import Enum
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, bindparam, func, inspect, or_, select, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from service.cache import LRUCache, MISSING
+from service.pool import engine_options
+from service.logs import kv
+from service.metrics import CACHE_LOOKUPS, LIKES_WRITTEN
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Range of the Integer columns
+MIN_ID, MAX_ID = -2 ** 31, 2 ** 31 - 1
+# Products whose versions are bumped per statement, below the SQLite bound parameter limit
+BUMP_CHUNK_SIZE = 500
+# Stamps the version bumps, created by create_all() on the databases that have sequences
+UPDATED_SEQ = db.Sequence("product_version_updated_seq", metadata=db.metadata)
+
+
+def create_tables():
+    """
+    Creates the tables that do not exist yet, and the indexes missing from those that do
+
+    create_all() skips the tables that exist, so an index added to a deployed
+    table would never be created by it.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info("Creating index %s on %s", index.name, table.name)
+                index.create(bind=db.engine)
+
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
@@ -25,7 +56,98 @@ class Type(Enum):
     CROSS_SELL = 1
     UP_SELL = 2
     ACCESSORY = 3
-    
+
+### -----------------------------------------------------------
+### CLASS PRODUCT VERSION
+### -----------------------------------------------------------
+class ProductVersion(db.Model):
+    """
+    Class that counts the writes to the Recommendations of a product
+
+    The version is bumped in the same transaction as every write, it is used
+    as the ETag of the product's Recommendations. Versions are never reset so
+    an ETag is never reused for different content. Every bump also stamps
+    updated_seq with the next value of a sequence, readers find the products
+    written since they last looked with it. The values are handed out without
+    a lock, so they do not commit in order: a reader has to look back a
+    margin behind the last value it saw.
+    """
+
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_seq = db.Column(db.BigInteger, nullable=False, default=0, index=True)
+
+    @classmethod
+    def _next_seq(cls):
+        """ Returns the expression of the next updated_seq value """
+        if db.engine.dialect.name == "postgresql":
+            return UPDATED_SEQ.next_value()
+        # SQLite has no sequences, but it runs one write transaction at a time
+        table = cls.__table__
+        return select([func.coalesce(func.max(table.c.updated_seq), 0) + 1]).as_scalar()
+
+    @classmethod
+    def bump(cls, product_ids):
+        """ Increments the version of the given products, call it before committing the write """
+        product_ids = sorted(set(product_ids))  # a fixed lock order avoids deadlocks
+        if not product_ids:
+            return
+        table = cls.__table__
+        for start in range(0, len(product_ids), BUMP_CHUNK_SIZE):
+            chunk = product_ids[start:start + BUMP_CHUNK_SIZE]
+            if db.engine.dialect.name == "postgresql":
+                statement = postgresql.insert(table).values([
+                    {"product_id": product_id, "version": 1, "updated_seq": cls._next_seq()} for product_id in chunk
+                ])
+                db.session.execute(statement.on_conflict_do_update(
+                    index_elements=[table.c.product_id],
+                    set_={"version": table.c.version + 1, "updated_seq": cls._next_seq()}
+                ))
+                continue
+            db.session.execute(table.update().where(table.c.product_id.in_(chunk)).values(
+                version=table.c.version + 1, updated_seq=cls._next_seq()))
+            existing = {row[0] for row in db.session.execute(select([table.c.product_id]).where(table.c.product_id.in_(chunk)))}
+            missing = [product_id for product_id in chunk if product_id not in existing]
+            if missing:
+                db.session.execute(table.insert().values([
+                    {"product_id": product_id, "version": 1, "updated_seq": cls._next_seq()} for product_id in missing
+                ]))
+
+    @classmethod
+    def bump_all(cls):
+        """ Increments the version of every product, call it before committing the write """
+        table = cls.__table__
+        db.session.execute(table.update().values(version=table.c.version + 1, updated_seq=cls._next_seq()))
+
+    @classmethod
+    def changed_since(cls, sequence):
+        """ Returns the (product_id, version, updated_seq) rows of the products bumped after the sequence value """
+        return db.session.query(cls.product_id, cls.version, cls.updated_seq).filter(cls.updated_seq > sequence).all()
+
+    @classmethod
+    def lock(cls, product_id):
+        """
+        Returns the version of a product, locking it until the end of the transaction
+
+        The row is created first when the product was never written, so there is
+        always a row to lock and two writers expecting version 0 cannot both pass.
+        """
+        table = cls.__table__
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(postgresql.insert(table).values(product_id=product_id, version=0).on_conflict_do_nothing())
+        elif not db.session.execute(select([table.c.product_id]).where(table.c.product_id == product_id)).first():
+            db.session.execute(table.insert().values(product_id=product_id, version=0))
+        return cls.find_version(product_id, lock=True)
+
+    @classmethod
+    def find_version(cls, product_id, lock=False):
+        """ Returns the version of a product, locking it until the end of the transaction if asked """
+        query = db.session.query(cls.version).filter(cls.product_id == product_id)
+        if lock:
+            query = query.with_for_update()
+        row = query.first()
+        return row[0] if row else 0
+
 ### -----------------------------------------------------------
 ### CLASS RECOMMENDATION
 ### -----------------------------------------------------------
@@ -35,6 +157,9 @@ class Recommendation(db.Model):
     """
 
     app = None
+    cache = None  # read-through LRUCache, set up by init_db() when CACHE_ENABLED
+    graph = None  # in-memory RecommendationGraph, set up on its first use
+    snapshot_reader = None  # SnapshotReader of the published snapshot, set up on its first use
 
     # Table Schema
     product_id = db.Column(db.Integer, primary_key=True)
@@ -43,6 +168,13 @@ class Recommendation(db.Model):
         db.Enum(Type), nullable=False, server_default=(Type.GO_TOGETHER.name)
         )
     likes = db.Column(db.Integer, default=0)
+
+    # Top-N queries for a product and type are a range scan of the first index, which also
+    # serves product and type lookups. The second one answers "who recommends this product".
+    __table_args__ = (
+        db.Index("ix_recommendation_top", product_id, relationship, likes.desc(), recommendation_product_id),
+        db.Index("ix_recommendation_reverse", recommendation_product_id, relationship, product_id),
+    )
     ### -----------------------------------------------------------
     ### INSTANCE METHODS
     ### -----------------------------------------------------------
@@ -61,7 +193,10 @@ class Recommendation(db.Model):
             raise DataValidationError("Recommendation already exits")
         
         db.session.add(self)
+        db.session.flush()  # the row before the version, every write locks them in this order
+        ProductVersion.bump([self.product_id])
         db.session.commit()
+        self.invalidate(self.product_id, self.recommendation_product_id)
 
 
     def update(self):
@@ -71,7 +206,10 @@ class Recommendation(db.Model):
         if not self.product_id or not self.recommendation_product_id or not self.relationship:
             raise DataValidationError("Product id, recommendation product id and relationship required!")
         logger.info("updating relationship between %s and %s", self.product_id, self.recommendation_product_id)
+        db.session.flush()  # the row before the version, every write locks them in this order
+        ProductVersion.bump([self.product_id])
         db.session.commit()
+        self.invalidate(self.product_id, self.recommendation_product_id)
         
     def delete(self):
         """
@@ -79,12 +217,21 @@ class Recommendation(db.Model):
         """
         logger.info("Deleting %s between %s and %s", self.relationship, self.product_id, self.recommendation_product_id)
         db.session.delete(self)
+        db.session.flush()  # the row before the version, every write locks them in this order
+        ProductVersion.bump([self.product_id])
         db.session.commit()
+        self.invalidate(self.product_id, self.recommendation_product_id)
 
     def serialize(self):
         """ Serializes a Recommendation into a dictionary """
         return {"product_id": self.product_id, "recommendation_product_id": self.recommendation_product_id, "relationship": self.relationship.name, "likes": self.likes}
 
+    @staticmethod
+    def serialize_row(row):
+        """ Serializes a (product_id, recommendation_product_id, relationship, likes) row into a dictionary """
+        product_id, recommendation_product_id, relationship, likes = row
+        return {"product_id": product_id, "recommendation_product_id": recommendation_product_id, "relationship": relationship.name, "likes": likes}
+
     def deserialize(self, data):
         """
         Deserializes a Recommendation from a dictionary
@@ -106,45 +253,396 @@ class Recommendation(db.Model):
             )
         return self
     
+    @staticmethod
+    def validate(data):
+        """
+        Validates a dictionary for insertion and returns the row to insert
+
+        Args:
+            data (dict): A dictionary containing the resource data
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid Recommendation Model: body of request contained bad or no data")
+        row = {}
+        for key in ("product_id", "recommendation_product_id"):
+            value = data.get(key)
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise DataValidationError("Invalid Recommendation Model: {} must be an integer".format(key))
+            if not MIN_ID <= value <= MAX_ID:
+                raise DataValidationError("Invalid Recommendation Model: {} is out of range".format(key))
+            row[key] = value
+        relationship = data.get("relationship")
+        if relationship not in Type.__members__:
+            raise DataValidationError(
+                "Bad relationship input. Supported relationships are {}".format(list(Type.__members__))
+            )
+        row["relationship"] = Type[relationship]
+        row["likes"] = 0
+        return row
+
     ### -----------------------------------------------------------
     ### CLASS METHODS
     ### -----------------------------------------------------------
 
     @classmethod
-    def init_db(cls, app):
-        """ Initializes the database session """
+    def init_db(cls, app, create_schema=True):
+        """ Initializes the database session, creating the tables unless create_schema is False """
         logger.info("Initializing database")
         cls.app = app
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        if create_schema:
+            create_tables()  # make our sqlalchemy tables and their indexes
+        cls.cache = None
+        if app.config.get("CACHE_ENABLED"):
+            cls.cache = LRUCache(app.config["CACHE_MAX_ENTRIES"], app.config["CACHE_TTL_SECONDS"])
 
     @classmethod
-    def find(cls, product_id, recommendation_product_id):
-        """ Finds relationship between two product ids """
-        logger.info("Processing lookup for id %s %s", product_id, recommendation_product_id)
-        
+    def invalidate(cls, product_id, recommendation_product_id=None):
+        """ Drops the cached reads of a product, and of one of its pairs if given """
+        if cls.graph is not None:
+            cls.graph.mark_dirty(product_id)
+        if cls.snapshot_reader is not None:
+            cls.snapshot_reader.mark_dirty(product_id)
+        if cls.cache is None:
+            return
+        keys = [("group", product_id, type) for type in Type.__members__]
+        if recommendation_product_id is not None:
+            keys.append(("pair", product_id, recommendation_product_id))
+        cls.cache.delete(*keys)
+
+    @classmethod
+    def _cached(cls, key, load, version=None):
+        """
+        Returns the cached value for key, calling load() and caching the result on a miss
+
+        The value is cached with the product version it was loaded under. When a version
+        is given a value of another version is a miss: the writes of other workers do not
+        invalidate this cache, but they do bump the version.
+        """
+        if cls.cache is None:
+            return load()
+        entry = cls.cache.get(key, valid=None if version is None else lambda entry: entry[0] == version)
+        if entry is MISSING:
+            CACHE_LOOKUPS.labels("miss").inc()
+            entry = (version, load())
+            cls.cache.set(key, entry)
+        else:
+            CACHE_LOOKUPS.labels("hit").inc()
+        return entry[1]
+
+    @classmethod
+    def find(cls, product_id, recommendation_product_id, lock=False):
+        """ Finds relationship between two product ids, locking it until the end of the transaction if asked """
+        logger.debug("Processing lookup", extra=kv(product_id=product_id, recommendation_product_id=recommendation_product_id))
+        if lock:
+            return cls.query.filter_by(product_id=product_id, recommendation_product_id=recommendation_product_id) \
+                .with_for_update().first()
         return cls.query.get((product_id, recommendation_product_id))
 
+    @classmethod
+    def rows(cls):
+        """
+        Returns a query for (product_id, recommendation_product_id, relationship, likes) rows
+
+        Read paths use it instead of cls.query: the columns come back as named
+        tuples, without building ORM instances or adding them to the session's
+        identity map. Serialize them with serialize_row.
+        """
+        return db.session.query(cls.product_id, cls.recommendation_product_id, cls.relationship, cls.likes)
+
+    @classmethod
+    def find_serialized(cls, product_id, recommendation_product_id, version=None):
+        """
+        Returns the serialized relationship between two product ids, or None, through the cache
+
+        When the version of product_id is given, a cached value of an older version is not used
+        """
+        def load():
+            row = cls.rows().filter(cls.product_id == product_id,
+                                    cls.recommendation_product_id == recommendation_product_id).first()
+            return cls.serialize_row(row) if row else None
+        return cls._cached(("pair", product_id, recommendation_product_id), load, version)
+
+    @classmethod
+    def create_many(cls, records, chunk_size=500):
+        """
+        Creates many Recommendations in a single transaction
+
+        Every record is validated first. Invalid records and records whose key already
+        exists are reported instead of aborting the batch, the rest are written with
+        multi-row inserts of chunk_size rows.
+
+        Returns a list with one status per record: "created", "duplicate" or "invalid"
+        """
+        logger.info("Creating a batch of %s recommendations", len(records))
+        try:
+            return cls._create_many(records, chunk_size)
+        except IntegrityError:
+            # a concurrent writer inserted one of our keys, start over so it is reported as a duplicate
+            db.session.rollback()
+            logger.warning("Batch conflicted with a concurrent write, retrying")
+        try:
+            return cls._create_many(records, chunk_size)
+        except IntegrityError:
+            db.session.rollback()
+            raise DataValidationError("Batch conflicted with concurrent writes, please retry")
+
+    @classmethod
+    def _create_many(cls, records, chunk_size):
+        """ Writes a batch of records, see create_many() """
+        results = []
+        pending = {}
+        for index, data in enumerate(records):
+            try:
+                row = cls.validate(data)
+            except DataValidationError as error:
+                results.append({"index": index, "status": "invalid", "message": str(error)})
+                continue
+            key = (row["product_id"], row["recommendation_product_id"])
+            result = {"index": index, "product_id": key[0], "recommendation_product_id": key[1]}
+            if key in pending:
+                result["status"] = "duplicate"
+            else:
+                result["status"] = "created"
+                pending[key] = (row, result)
+            results.append(result)
+
+        items = list(pending.items())
+        for start in range(0, len(items), chunk_size):
+            chunk = dict(items[start:start + chunk_size])
+            for key in cls.find_existing_keys(list(chunk)):
+                chunk.pop(key)[1]["status"] = "duplicate"
+            if chunk:
+                db.session.execute(cls.__table__.insert().values([row for row, _ in chunk.values()]))
+        ProductVersion.bump(key[0] for key, (_, result) in pending.items() if result["status"] == "created")
+        db.session.commit()
+        for key in pending:
+            cls.invalidate(*key)
+        return results
+
+    @classmethod
+    def find_pairs(cls, keys):
+        """
+        Returns the serialized Recommendations of many (product_id, recommendation_product_id) keys
+
+        All keys are resolved with a single tuple IN query on the primary key. Returns a
+        dictionary mapping each key that exists to its Recommendation.
+        """
+        logger.debug("Processing pair lookup", extra=kv(pairs=len(keys)))
+        if not keys:
+            return {}
+        query = cls.rows().filter(tuple_(cls.product_id, cls.recommendation_product_id).in_(keys))
+        return {(row.product_id, row.recommendation_product_id): cls.serialize_row(row) for row in query}
+
+    @classmethod
+    def find_existing_keys(cls, keys):
+        """Returns the subset of (product_id, recommendation_product_id) keys that already exist"""
+        if not keys:
+            return []
+        columns = (cls.product_id, cls.recommendation_product_id)
+        query = db.session.query(*columns).filter(tuple_(*columns).in_(keys))
+        return [tuple(row) for row in query]
+
+    @classmethod
+    def like(cls, product_id, recommendation_product_id, count=1):
+        """
+        Atomically adds count likes to a Recommendation
+
+        The increment is done by the database in a single UPDATE so concurrent likes
+        are never lost. Returns the serialized Recommendation, or None if it does not exist
+        """
+        logger.debug("Processing likes",
+                     extra=kv(product_id=product_id, recommendation_product_id=recommendation_product_id, count=count))
+        table = cls.__table__
+        columns = [table.c.product_id, table.c.recommendation_product_id, table.c.relationship, table.c.likes]
+        key = and_(table.c.product_id == product_id, table.c.recommendation_product_id == recommendation_product_id)
+        statement = table.update().where(key).values(likes=func.coalesce(table.c.likes, 0) + count)
+        if db.engine.dialect.implicit_returning:
+            row = db.session.execute(statement.returning(*columns)).first()
+        else:
+            # no RETURNING support, read the row back inside the same transaction
+            result = db.session.execute(statement)
+            row = db.session.execute(select(columns).where(key)).first() if result.rowcount else None
+        if row:
+            ProductVersion.bump([product_id])
+        db.session.commit()
+        if row:
+            LIKES_WRITTEN.labels("sync").inc(count)
+        cls.invalidate(product_id, recommendation_product_id)
+        return cls.serialize_row(row) if row else None
+
+    @classmethod
+    def add_likes(cls, deltas):
+        """
+        Adds many like counts in one batched UPDATE
+
+        Args:
+            deltas (dict): maps (product_id, recommendation_product_id) to the number of likes to add
+        """
+        if not deltas:
+            return
+        logger.info("Processing likes for %s recommendations", len(deltas))
+        table = cls.__table__
+        statement = table.update().where(
+            and_(table.c.product_id == bindparam("key_product_id"),
+                 table.c.recommendation_product_id == bindparam("key_recommendation_product_id"))
+        ).values(likes=func.coalesce(table.c.likes, 0) + bindparam("delta"))
+        # in key order, like bump(), so two workers flushing overlapping pairs do not deadlock
+        db.session.execute(statement, [
+            {"key_product_id": key[0], "key_recommendation_product_id": key[1], "delta": delta}
+            for key, delta in sorted(deltas.items())
+        ])
+        ProductVersion.bump(key[0] for key in deltas)
+        db.session.commit()
+        LIKES_WRITTEN.labels("write_behind").inc(sum(deltas.values()))
+        for key in deltas:
+            cls.invalidate(*key)
+
     @classmethod
     def all(cls):
         """Returns all of the Pets in the database"""
         logger.info("Processing all recommendation")
         return cls.query.all()
 
+    @classmethod
+    def find_page(cls, after=None, limit=100):
+        """Returns up to limit Recommendation rows in primary key order, starting after the given key
+
+        Args:
+            after (tuple): the (product_id, recommendation_product_id) of the last row already seen
+            limit (int): the maximum number of rows to return
+        """
+        logger.debug("Processing page query", extra=kv(after=after, limit=limit))
+        query = cls.rows().order_by(cls.product_id, cls.recommendation_product_id)
+        if after:
+            query = query.filter(tuple_(cls.product_id, cls.recommendation_product_id) > tuple_(*after))
+        return query.limit(limit).all()
+
+    @classmethod
+    def stream_all(cls, chunk_size=1000):
+        """Yields all of the Recommendation rows in primary key order, chunk_size rows at a time
+
+        The rows are read through a server side cursor so memory use does not
+        grow with the size of the table.
+        """
+        logger.info("Processing streaming export with chunk size %s", chunk_size)
+        query = cls.rows().order_by(cls.product_id, cls.recommendation_product_id)
+        return query.yield_per(chunk_size)
+
     @classmethod
     def find_by_id_and_type(cls, product_id, type):
         """Returns all Recommendations with the given product id and type"""
-        logger.info("Processing id and type query for id %s and type %s", product_id, type)
+        logger.debug("Processing id and type query", extra=kv(product_id=product_id, type=type))
         if not type:
             raise DataValidationError("Type is required to query!")
         return cls.query.filter(cls.product_id == product_id).filter(cls.relationship == type)
 
+    @classmethod
+    def find_group(cls, product_id, type, version=None):
+        """
+        Returns the serialized Recommendations with the given product id and type, through the cache
+
+        When the version of product_id is given, a cached value of an older version is not used
+        """
+        if not type:
+            raise DataValidationError("Type is required to query!")
+        type = type.name if isinstance(type, Type) else type
+        logger.debug("Processing group query", extra=kv(product_id=product_id, type=type))
+        def load():
+            query = cls.rows().filter(cls.product_id == product_id).filter(cls.relationship == type)
+            return [cls.serialize_row(row) for row in query]
+        return cls._cached(("group", product_id, type), load, version)
+
+    @classmethod
+    def find_by_ids_and_type(cls, product_ids, type=None):
+        """
+        Returns the serialized Recommendations of many product ids with one query
+
+        Returns a dictionary mapping every product id to its list of Recommendations,
+        optionally only those of the given type
+        """
+        logger.debug("Processing ids and type query", extra=kv(product_ids=len(product_ids), type=type))
+        groups = {product_id: [] for product_id in product_ids}
+        if not groups:
+            return groups
+        query = cls.rows().filter(cls.product_id.in_(groups))
+        if type:
+            query = query.filter(cls.relationship == type)
+        for row in query.order_by(cls.product_id, cls.recommendation_product_id):
+            groups[row.product_id].append(cls.serialize_row(row))
+        return groups
+
+    @classmethod
+    def find_top(cls, product_id, type=None, limit=10):
+        """Returns the limit most liked Recommendation rows for a product id, optionally of one type"""
+        logger.debug("Processing top query", extra=kv(product_id=product_id, type=type, limit=limit))
+        query = cls.rows().filter(cls.product_id == product_id)
+        if type:
+            query = query.filter(cls.relationship == type)
+        return query.order_by(cls.likes.desc(), cls.recommendation_product_id).limit(limit).all()
+
+    @classmethod
+    def find_recommenders(cls, recommendation_product_id, type=None):
+        """Returns all Recommendation rows that point at the given recommended product id, optionally of one type"""
+        logger.debug("Processing recommenders query", extra=kv(recommendation_product_id=recommendation_product_id, type=type))
+        query = cls.rows().filter(cls.recommendation_product_id == recommendation_product_id)
+        if type:
+            query = query.filter(cls.relationship == type)
+        return query.order_by(cls.product_id).all()
+
+    @classmethod
+    def delete_products(cls, product_ids, type=None, direction="out"):
+        """
+        Deletes the Recommendations of many products in one statement
+
+        direction "out" deletes the Recommendations of the products, "in" those
+        recommending them and "both" all of them, optionally only of one type.
+        Both columns lead an index, so the delete never scans the table. Returns
+        the number of Recommendations deleted.
+        """
+        logger.info("Deleting the recommendations of %s products", len(product_ids),
+                    extra=kv(type=type, direction=direction))
+        product_ids = sorted(set(product_ids))
+        if not product_ids:
+            return 0
+        table = cls.__table__
+        conditions = []
+        if direction in ("out", "both"):
+            conditions.append(table.c.product_id.in_(product_ids))
+        if direction in ("in", "both"):
+            conditions.append(table.c.recommendation_product_id.in_(product_ids))
+        where = or_(*conditions)
+        if type:
+            where = and_(where, table.c.relationship == Type[type])
+        columns = [table.c.product_id, table.c.recommendation_product_id]
+        statement = table.delete().where(where)
+        if db.engine.dialect.implicit_returning:
+            keys = db.session.execute(statement.returning(*columns)).fetchall()
+        else:
+            # no RETURNING support, read the keys first inside the same transaction
+            keys = db.session.execute(select(columns).where(where)).fetchall()
+            db.session.execute(statement)
+        # the groups of every product that lost a Recommendation changed
+        ProductVersion.bump(key[0] for key in keys)
+        db.session.commit()
+        for product_id, recommendation_product_id in keys:
+            cls.invalidate(product_id, recommendation_product_id)
+        return len(keys)
+
     @classmethod
     def clear(cls):
         '''Clear all data entries'''
         logger.info("Processing clearing all data entries")
         cls.query.delete()
+        ProductVersion.bump_all()
         db.session.commit()
+        if cls.cache is not None:
+            cls.cache.clear()
+        if cls.graph is not None:
+            cls.graph.mark_dirty()
+        if cls.snapshot_reader is not None:
+            cls.snapshot_reader.mark_dirty()
 
@@ -0,0 +1,91 @@
+"""
+Database connection pool
+
+Builds the SQLAlchemy engine options from the DB_POOL_* settings and
+provides a QueuePool that measures how long requests wait for a connection,
+so the pool can be sized against the workers and Postgres max_connections.
+"""
+import time
+import threading
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that counts checkouts, timeouts and the time spent waiting for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return connection
+
+    def stats(self):
+        """ Returns the connection counts and wait times of the pool as a dictionary """
+        with self._stats_lock:
+            return {
+                "pool_class": type(self).__name__,
+                "pool_size": self.size(),
+                "max_overflow": self._max_overflow,
+                "checked_out": self.checkedout(),
+                "idle": self.checkedin(),
+                "overflow": max(self.overflow(), 0),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "wait_seconds_avg": self.wait_seconds_total / self.checkouts if self.checkouts else 0.0,
+            }
+
+
+def engine_options(config):
+    """
+    Returns the SQLALCHEMY_ENGINE_OPTIONS for the configured database
+
+    SQLite keeps the pooling Flask-SQLAlchemy picks for it, the pool sizing
+    only applies to server databases.
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if url.drivername.startswith("sqlite"):
+        return options
+    options.update({
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+    })
+    if url.drivername.startswith("postgres") and config["DB_STATEMENT_TIMEOUT_MS"]:
+        options["connect_args"] = {"options": "-c statement_timeout={}".format(config["DB_STATEMENT_TIMEOUT_MS"])}
+    return options
+
+
+def pool_stats(engine):
+    """ Returns the statistics of the engine's pool, wait times are only measured by a TimedQueuePool """
+    pool = engine.pool
+    if isinstance(pool, TimedQueuePool):
+        return pool.stats()
+    stats = {"pool_class": type(pool).__name__}
+    for name, method in [("pool_size", "size"), ("checked_out", "checkedout"), ("idle", "checkedin")]:
+        if hasattr(pool, method):
+            stats[name] = getattr(pool, method)()
+    return stats
@@ -0,0 +1,168 @@
+"""
+On-demand request profiling
+
+A request is profiled when it carries an X-Profile-Token header equal to
+PROFILE_TOKEN, or when it is picked by PROFILE_SAMPLE_RATE. Its cProfile
+trace and every SQL statement it ran, with timings, are written to
+PROFILE_DIR, which keeps only the latest PROFILE_MAX_FILES profiles. The
+profile id is returned in the X-Profile-Id response header and the profiles
+are read back through /api/internal/profiles with the same token.
+"""
+import io
+import os
+import re
+import json
+import time
+import uuid
+import pstats
+import random
+import cProfile
+import hmac
+from datetime import datetime, timezone
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TOKEN_HEADER = "X-Profile-Token"
+ID_HEADER = "X-Profile-Id"
+# Only ids made by new_id() are read back, which keeps lookups inside the profile directory
+ID_PATTERN = re.compile(r"^\d{8}T\d{12}-[0-9a-f]{8}$")
+# Longest parameter list kept per SQL statement
+MAX_PARAMETERS_LENGTH = 500
+
+
+def new_id():
+    """ Returns a unique profile id that sorts by creation time """
+    return "{}-{}".format(datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f"), uuid.uuid4().hex[:8])
+
+
+class ProfileStore:
+    """ A directory holding the latest max_profiles profiles, the oldest ones are removed first """
+
+    def __init__(self, directory, max_profiles=50):
+        self.directory = directory
+        self.max_profiles = max_profiles
+
+    def path(self, profile_id, extension):
+        return os.path.join(self.directory, "{}.{}".format(profile_id, extension))
+
+    def save(self, profile_id, summary, profiler):
+        """ Writes the summary and the cProfile stats of a request, then trims the ring """
+        os.makedirs(self.directory, exist_ok=True)
+        profiler.dump_stats(self.path(profile_id, "prof"))
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(30)
+        summary = dict(summary, id=profile_id, report=report.getvalue())
+        # written last and renamed into place, a listed profile is always complete
+        temporary = self.path(profile_id, "json.tmp")
+        with open(temporary, "w") as summary_file:
+            json.dump(summary, summary_file)
+        os.replace(temporary, self.path(profile_id, "json"))
+        self.trim()
+
+    def ids(self):
+        """ Returns the ids of the stored profiles, newest first """
+        if not os.path.isdir(self.directory):
+            return []
+        names = (name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json"))
+        return sorted((name for name in names if ID_PATTERN.match(name)), reverse=True)
+
+    def trim(self):
+        """ Removes the oldest profiles beyond max_profiles """
+        for profile_id in self.ids()[self.max_profiles:]:
+            for extension in ("json", "prof"):
+                try:
+                    os.remove(self.path(profile_id, extension))
+                except FileNotFoundError:  # trimmed by another worker
+                    pass
+
+    def load(self, profile_id):
+        """ Returns the summary of a profile, or None if it does not exist """
+        if not ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self.path(profile_id, "json")) as summary_file:
+                return json.load(summary_file)
+        except FileNotFoundError:
+            return None
+
+    def stats_path(self, profile_id):
+        """ Returns the path of the cProfile stats of a profile, or None if it does not exist """
+        if not ID_PATTERN.match(profile_id):
+            return None
+        path = self.path(profile_id, "prof")
+        return path if os.path.exists(path) else None
+
+
+class RequestProfiler:
+    """ Decides which requests to profile and records their cProfile trace and SQL statements """
+
+    def __init__(self, store, token="", sample_rate=0.0, random=random.random):
+        self.store = store
+        self.token = token
+        self.sample_rate = sample_rate
+        self._random = random
+
+    def authorized(self):
+        """ Returns True if the request carries the profiling token """
+        given = request.headers.get(TOKEN_HEADER)
+        return bool(self.token and given) and hmac.compare_digest(given, self.token)
+
+    def start_request(self):
+        stale = g.pop("profiler", None)
+        if stale is not None:  # a request that failed before finish_request
+            stale.disable()
+        if not (self.authorized() or (self.sample_rate and self._random() < self.sample_rate)):
+            return
+        g.sql_trace = []
+        g.profile_start = time.perf_counter()
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+    def finish_request(self, response):
+        # g can outlive the request when an app context was already pushed, so clear it
+        profiler = g.pop("profiler", None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        sql_trace = g.pop("sql_trace")
+        profile_id = new_id()
+        summary = {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "status": response.status_code,
+            "duration_seconds": time.perf_counter() - g.pop("profile_start"),
+            "sql_count": len(sql_trace),
+            "sql_seconds": sum(statement["seconds"] for statement in sql_trace),
+            "sql": sql_trace,
+        }
+        self.store.save(profile_id, summary, profiler)
+        response.headers[ID_HEADER] = profile_id
+        return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["profile_query_start"].pop()
+    if has_request_context() and "sql_trace" in g:
+        g.sql_trace.append({
+            "statement": statement,
+            "parameters": repr(parameters)[:MAX_PARAMETERS_LENGTH],
+            "seconds": time.perf_counter() - started,
+        })
+
+
+def init_profiling(app):
+    """ Returns the RequestProfiler configured by the PROFILE_* settings, hooked into the app """
+    store = ProfileStore(app.config["PROFILE_DIR"], app.config["PROFILE_MAX_FILES"])
+    profiler = RequestProfiler(store, app.config["PROFILE_TOKEN"], app.config["PROFILE_SAMPLE_RATE"])
+    app.before_request(profiler.start_request)
+    app.after_request(profiler.finish_request)
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    return profiler
@@ -23,12 +23,25 @@ import service.error_handlers
 from . import app
 
 import sys
+import json
+import time
 import uuid
+import base64
 import logging
 from functools import wraps
-from flask import jsonify, request, url_for, make_response, render_template
+from flask import jsonify, request, url_for, make_response, render_template, Response, stream_with_context, send_file
 from flask_restx import Api, Resource, fields, reqparse, inputs
-from service.models import Recommendation, DataValidationError
+from werkzeug.http import quote_etag
+from service.models import db, Recommendation, ProductVersion, DataValidationError, MIN_ID, MAX_ID
+from service.likes import LikeBuffer
+from service.graph import RecommendationGraph
+from service.snapshot import SnapshotReader
+from service.cache import MISSING
+from service.pool import pool_stats
+from service.serializers import RowSerializer, json_response
+from service.logs import kv
+from service.metrics import init_metrics, latest as latest_metrics
+from service.profiling import init_profiling
 from . import app, status    # HTTP Status Codes
 
 # Document the type of autorization required
@@ -51,30 +64,84 @@ Recommendations Service
 
 Paths:
 ------
-GET /recommendations - Returns a list all of the Recommendations
+GET /recommendations?limit={n}&after={cursor} - Returns a page of the Recommendations
+GET /recommendations?product_ids={id},{id}&type={relationship-type} - Returns the Recommendations of many products
+POST /recommendations/query - Returns the Recommendations of many products listed in the body
+POST /recommendations/lookup - Returns the Recommendations of many (product, recommended product) pairs
+GET /recommendations/export - Streams all of the Recommendations as NDJSON
 GET /recommendations/{id}/recommended-products/{id} - Returns the Recommendation with a given id number and related product id
 GET /recommendations/{id}?type={relationship-type}
+GET /recommendations/{id}/top?limit={k}&type={relationship-type} - Returns the k most liked Recommendations
+GET /recommendations/{id}/expanded?depth={n}&type={relationship-type} - Returns the products reachable in up to n hops
+GET /recommended-products/{id}/recommenders?type={relationship-type} - Returns the Recommendations pointing at a product
 POST /recommendations - creates a new Recommendation record in the database
+POST /recommendations/batch - creates many Recommendation records in one transaction
 PUT /recommendations/{id}/recommended-products/{id} - updates a Recommendation record in the database
 DELETE /recommendations/{id}/recommended-products/{id} - deletes a Recommendation record in the database
+DELETE /recommendations/{id}?type={relationship-type}&direction={out|in|both} - deletes the Recommendations of a product
+POST /recommendations/retire - deletes the Recommendations of many products in one statement
 DELETE /recommendations - deletes all Recommendation record in the database
+GET /internal/cache - Returns the size and hit/miss/eviction counters of the read cache
+GET /internal/pool - Returns the connection counts and wait times of the database pool
+GET /internal/profiles - Returns the stored request profiles, needs X-Profile-Token
+GET /internal/profiles/{id} - Returns a request profile with its SQL statements
+GET /internal/profiles/{id}/pstats - Returns the raw cProfile stats of a request
 """
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
-def check_content_type(content_type):
+def check_content_type(*content_types):
     """ Checks that the media type is correct """
-    if "Content-Type" in request.headers and request.headers["Content-Type"] == content_type:
+    if "Content-Type" in request.headers and request.headers["Content-Type"] in content_types:
         return
     app.logger.error("Invalid Content-Type: [%s]", request.headers.get("Content-Type"))
-    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be {}".format(content_type))
+    abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be {}".format(" or ".join(content_types)))
 
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
     api.abort(error_code, message)
 
+def check_profile_token():
+    """ Aborts unless the request carries the PROFILE_TOKEN """
+    if not request_profiler.authorized():
+        abort(status.HTTP_403_FORBIDDEN, "A valid X-Profile-Token header is required")
+
+def product_etag(product_id, version):
+    """ Builds the (unquoted) ETag of a product's Recommendations from its version """
+    return "{}-{}".format(product_id, version)
+
+def masked(serializer):
+    """ Returns the serializer of the fields selected by the X-Fields mask of the request, if any """
+    return serializer.masked(request.headers.get(app.config['RESTX_MASK_HEADER']))
+
+def lookup_products(product_ids, type):
+    """ Returns a JSON response with the Recommendations of many products grouped by product id """
+    if len(product_ids) > app.config['MAX_PRODUCT_IDS']:
+        abort(status.HTTP_400_BAD_REQUEST,
+              "At most {} product ids can be looked up per request".format(app.config['MAX_PRODUCT_IDS']))
+    groups = Recommendation.find_by_ids_and_type(product_ids, type)
+    return json_response({
+        str(product_id): recommendation_serializer.project_all(rows) for product_id, rows in groups.items()
+    })
+
+def encode_cursor(product_id, recommendation_product_id):
+    """ Encodes a primary key into an opaque pagination cursor """
+    key = "{}:{}".format(product_id, recommendation_product_id)
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """ Decodes an opaque pagination cursor back into a primary key """
+    try:
+        key = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        product_id, recommendation_product_id = key.split(":")
+        return int(product_id), int(recommendation_product_id)
+    except (ValueError, UnicodeDecodeError):
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid pagination cursor: {}".format(cursor))
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -83,6 +150,22 @@ def index():
     """ Root URL response """
     return app.send_static_file("index.html")
 
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """ Returns the metrics of all workers in the Prometheus text format """
+    body, content_type = latest_metrics()
+    return Response(body, mimetype=content_type)
+
+
+if app.config['METRICS_ENABLED']:
+    init_metrics(app)
+
+request_profiler = init_profiling(app)
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
@@ -116,6 +199,167 @@ recommendation_model = api.inherit(
     }
 )
 
+batch_item_model = api.model('BatchItemResult', {
+    'index': fields.Integer(description='Position of the item in the request'),
+    'product_id': fields.Integer(description='The id of the product'),
+    'recommendation_product_id': fields.Integer(description='The id of the recommended product'),
+    'status': fields.String(description='One of created, duplicate or invalid'),
+    'message': fields.String(description='Why the item was rejected'),
+})
+
+batch_result_model = api.model('BatchResult', {
+    'created': fields.Integer(description='Number of Recommendations created'),
+    'duplicate': fields.Integer(description='Number of items whose Recommendation already existed'),
+    'invalid': fields.Integer(description='Number of items that failed validation'),
+    'results': fields.List(fields.Nested(batch_item_model, skip_none=True)),
+})
+# The read endpoints encode rows straight to JSON instead of marshalling them
+recommendation_serializer = RowSerializer(recommendation_model)
+# They apply the X-Fields mask themselves, documented like marshal_with documents it
+mask_params = {app.config['RESTX_MASK_HEADER']: {
+    'in': 'header', 'type': 'string', 'format': 'mask', 'description': 'An optional fields mask',
+}}
+
+# Query string arguments for paging through the list of Recommendations
+list_args = reqparse.RequestParser()
+list_args.add_argument('limit', type=inputs.positive, required=False, location='args',
+                       help='Maximum number of Recommendations to return (capped by the server)')
+list_args.add_argument('after', type=str, required=False, location='args',
+                       help='Opaque cursor taken from the Link header of the previous page')
+list_args.add_argument('product_ids', type=str, required=False, location='args',
+                       help='Comma separated product ids, returns their Recommendations grouped by product id')
+list_args.add_argument('type', type=str, required=False, location='args', choices=[t.name for t in Type],
+                       help='Only return Recommendations with this relationship, used with product_ids')
+
+product_query_model = api.model('ProductQuery', {
+    'product_ids': fields.List(fields.Integer(min=MIN_ID, max=MAX_ID), required=True,
+                               description='The ids of the products'),
+    'type': fields.String(required=False, enum=[t.name for t in Type],
+                          description='Only return Recommendations with this relationship'),
+})
+
+pair_model = api.model('RecommendationKey', {
+    'product_id': fields.Integer(required=True, min=MIN_ID, max=MAX_ID, description='The id of the product'),
+    'recommendation_product_id': fields.Integer(required=True, min=MIN_ID, max=MAX_ID,
+                                                description='The id of the recommended product'),
+})
+
+lookup_model = api.model('PairLookup', {
+    'pairs': fields.List(fields.Nested(pair_model), required=True,
+                         description='The pairs to look up, at most LOOKUP_MAX_PAIRS (1000)'),
+})
+
+lookup_result_model = api.model('PairLookupResult', {
+    'found': fields.List(fields.Nested(recommendation_model), description='The Recommendations that exist'),
+    'missing': fields.List(fields.Nested(pair_model), description='The pairs that have no Recommendation'),
+})
+
+products_model = api.model('RecommendationsByProduct', {
+    '*': fields.Wildcard(fields.List(fields.Nested(recommendation_model)),
+                         description='The Recommendations of each requested product id'),
+})
+
+# Query string arguments for the top-N Recommendations of a product
+top_args = reqparse.RequestParser()
+top_args.add_argument('limit', type=inputs.positive, required=False, location='args',
+                      help='Number of Recommendations to return (capped by the server)')
+top_args.add_argument('type', type=str, required=False, location='args', choices=[t.name for t in Type],
+                      help='Only return Recommendations with this relationship')
+
+# Query string arguments for the expanded (multi-hop) Recommendations
+expanded_args = reqparse.RequestParser()
+expanded_args.add_argument('depth', type=inputs.positive, required=False, location='args',
+                           help='Most hops to follow from the product, 2 by default (capped by the server)')
+expanded_args.add_argument('type', type=str, required=False, location='args', choices=[t.name for t in Type],
+                           help='Only follow Recommendations with this relationship')
+expanded_args.add_argument('limit', type=inputs.positive, required=False, location='args',
+                           help='Number of products to return (capped by the server)')
+
+expanded_model = api.model('ExpandedRecommendation', {
+    'product_id': fields.Integer(description='A product reachable from the requested one'),
+    'depth': fields.Integer(description='The fewest hops it takes to reach the product'),
+    'paths': fields.Integer(description='Number of paths of up to depth hops reaching the product'),
+    'likes': fields.Integer(description='Likes of the last edge of each path, added up'),
+    'score': fields.Float(description='Sum over the paths of (1 + likes of the last edge) / hops'),
+})
+expanded_serializer = RowSerializer(expanded_model)
+
+# Query string arguments for the reverse lookup of a recommended product
+recommenders_args = reqparse.RequestParser()
+recommenders_args.add_argument('type', type=str, required=False, location='args', choices=[t.name for t in Type],
+                               help='Only return Recommendations with this relationship')
+
+# Which Recommendations of a product are deleted
+DIRECTIONS = ['out', 'in', 'both']
+
+delete_args = reqparse.RequestParser()
+delete_args.add_argument('type', type=str, required=False, location='args', choices=[t.name for t in Type],
+                         help='Only delete Recommendations with this relationship')
+delete_args.add_argument('direction', type=str, required=False, location='args', choices=DIRECTIONS,
+                         help='out (default) deletes the Recommendations of the product, in those recommending it, '
+                              'both all of them')
+
+retire_model = api.model('ProductRetirement', {
+    'product_ids': fields.List(fields.Integer(min=MIN_ID, max=MAX_ID), required=True,
+                               description='The ids of the products, at most RETIRE_MAX_PRODUCTS (1000)'),
+    'type': fields.String(required=False, enum=[t.name for t in Type],
+                          description='Only delete Recommendations with this relationship'),
+    'direction': fields.String(required=False, enum=DIRECTIONS,
+                               description='out (default), in or both'),
+})
+
+delete_result_model = api.model('DeleteResult', {
+    'deleted': fields.Integer(description='Number of Recommendations deleted'),
+})
+
+cache_stats_model = api.model('CacheStats', {
+    'enabled': fields.Boolean(description='Whether the read cache is enabled'),
+    'size': fields.Integer(description='Number of cached entries'),
+    'maxsize': fields.Integer(description='Maximum number of cached entries'),
+    'ttl': fields.Float(description='Seconds an entry lives in the cache'),
+    'hits': fields.Integer(description='Lookups answered by the cache'),
+    'misses': fields.Integer(description='Lookups that went to the database'),
+    'hit_ratio': fields.Float(description='hits / (hits + misses)'),
+    'evictions': fields.Integer(description='Entries dropped to stay within maxsize'),
+    'expirations': fields.Integer(description='Entries dropped because their ttl passed'),
+})
+
+pool_stats_model = api.model('PoolStats', {
+    'pool_class': fields.String(description='The SQLAlchemy pool class in use'),
+    'pool_size': fields.Integer(description='Connections kept open by the pool'),
+    'max_overflow': fields.Integer(description='Connections allowed beyond pool_size'),
+    'checked_out': fields.Integer(description='Connections in use by requests'),
+    'idle': fields.Integer(description='Open connections waiting in the pool'),
+    'overflow': fields.Integer(description='Connections open beyond pool_size'),
+    'checkouts': fields.Integer(description='Connections handed out since the pool was created'),
+    'timeouts': fields.Integer(description='Checkouts that gave up after DB_POOL_TIMEOUT'),
+    'wait_seconds_total': fields.Float(description='Time spent waiting for a connection'),
+    'wait_seconds_max': fields.Float(description='Longest wait for a connection'),
+    'wait_seconds_avg': fields.Float(description='Average wait for a connection'),
+})
+
+sql_statement_model = api.model('SqlStatement', {
+    'statement': fields.String(description='The SQL sent to the database'),
+    'parameters': fields.String(description='The bound parameters, truncated'),
+    'seconds': fields.Float(description='Time spent executing the statement'),
+})
+
+profile_summary_model = api.model('ProfileSummary', {
+    'id': fields.String(description='The profile id, also returned in the X-Profile-Id header'),
+    'created': fields.String(description='When the request was profiled'),
+    'method': fields.String(description='The HTTP method of the request'),
+    'path': fields.String(description='The path and query string of the request'),
+    'status': fields.Integer(description='The status code of the response'),
+    'duration_seconds': fields.Float(description='Time spent handling the request while profiled'),
+    'sql_count': fields.Integer(description='Number of SQL statements executed'),
+    'sql_seconds': fields.Float(description='Time spent executing SQL statements'),
+})
+
+profile_model = api.inherit('Profile', profile_summary_model, {
+    'sql': fields.List(fields.Nested(sql_statement_model), description='Every SQL statement in order'),
+    'report': fields.String(description='The functions with the most cumulative time'),
+})
+
 
 ######################################################################
 # Special Error Handlers
@@ -134,9 +378,74 @@ def request_validation_error(error):
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 def init_db():
-    """ Initialies the SQLAlchemy app """
+    """
+    Initialies the SQLAlchemy app
+
+    The tables are only created when DB_CREATE_SCHEMA is set, and with LAZY_STARTUP
+    that is left to the first request so the worker starts serving sooner.
+    """
     global app
-    Recommendation.init_db(app)
+    create_schema = app.config['DB_CREATE_SCHEMA'] and not app.config['LAZY_STARTUP']
+    Recommendation.init_db(app, create_schema=create_schema)
+
+@app.before_first_request
+def verify_schema():
+    """ Creates the missing tables on the first request when their creation was deferred """
+    if app.config['LAZY_STARTUP'] and app.config['DB_CREATE_SCHEMA']:
+        start = time.perf_counter()
+        db.create_all()
+        app.logger.info("Verified database schema in %.3fs", time.perf_counter() - start)
+
+@app.teardown_request
+def remove_session(exception=None):
+    """
+    Ends the session of the request
+
+    init_db() leaves an app context pushed, so requests on the main thread never
+    push their own and Flask-SQLAlchemy's teardown_appcontext never runs for them.
+    """
+    db.session.remove()
+
+like_buffer = None
+
+def get_snapshot():
+    """ Returns the published Recommendation snapshot, or None when there is none or it is disabled """
+    if not app.config['SNAPSHOT_PATH']:
+        return None
+    if Recommendation.snapshot_reader is None:
+        Recommendation.snapshot_reader = SnapshotReader(app.config['SNAPSHOT_PATH'], app.config['SNAPSHOT_CHECK_SECONDS'],
+                                                        app.config['GRAPH_SEQUENCE_MARGIN'])
+    return Recommendation.snapshot_reader.current()
+
+def read_version(product_id):
+    """
+    Returns the snapshot that answers for a product, or None, with the version of the product
+
+    The version of a product the snapshot answers for is the one recorded in it, the
+    database is only read otherwise.
+    """
+    snapshot = get_snapshot()
+    version = snapshot.version(product_id) if snapshot else MISSING
+    if version is MISSING:
+        return None, ProductVersion.find_version(product_id)
+    return snapshot, version
+
+def get_graph():
+    """ Returns the in-memory Recommendation graph, created on first use """
+    if Recommendation.graph is None:
+        Recommendation.graph = RecommendationGraph(app.config['GRAPH_REFRESH_SECONDS'],
+                                                   app.config['GRAPH_COMPACT_THRESHOLD'],
+                                                   app.config['GRAPH_SEQUENCE_MARGIN'])
+    return Recommendation.graph
+
+def get_like_buffer():
+    """ Returns the write-behind like buffer, or None when likes are written straight through """
+    global like_buffer
+    if not app.config['LIKE_WRITE_BEHIND']:
+        return None
+    if like_buffer is None:
+        like_buffer = LikeBuffer(app, app.config['LIKE_FLUSH_INTERVAL_MS'], app.config['LIKE_FLUSH_MAX_PENDING'])
+    return like_buffer
 
 @api.route("/recommendations/<int:product_id>/recommended-products/<int:recommendation_product_id>")
 @api.param('product_id', 'The product identifier')
@@ -145,20 +454,31 @@ class RecommendationResource(Resource):
     ######################################################################
     # GET A RECOMMENDATION (RELATIONSHIP BETWEEN PRODUCTS)
     ######################################################################
-    @api.doc('get_recommendations')
+    @api.doc('get_recommendations', params=mask_params)
+    @api.response(200, 'Success', recommendation_model)
+    @api.response(304, 'Not modified since the ETag given in If-None-Match')
     @api.response(404, 'Recommendation not found')
-    @api.marshal_with(recommendation_model)
     def get(self, product_id, recommendation_product_id):
         """
         Retrieve recommendations for (product_id, recommendation_product_id)
 
         This endpoint will return a relationship between two product ids. 
+        The ETag changes on every write to the Recommendations of product_id.
         """
-        app.logger.info("Request for relationship between product ids: %s %s", product_id, recommendation_product_id)
-        recommendation = Recommendation.find(product_id, recommendation_product_id)
-        if not recommendation or not recommendation.relationship:
+        app.logger.info("Request for relationship between product ids",
+                        extra=kv(product_id=product_id, recommendation_product_id=recommendation_product_id))
+        # read the version before the row, the snapshot and the cache only answer for that version,
+        # so the ETag is never newer than the body; a snapshot hit never goes to the database
+        snapshot, version = read_version(product_id)
+        etag = product_etag(product_id, version)
+        if request.if_none_match.contains_weak(etag):
+            return '', status.HTTP_304_NOT_MODIFIED, {'ETag': quote_etag(etag)}
+        result = snapshot.find_pair(product_id, recommendation_product_id, version) if snapshot else MISSING
+        if result is MISSING:
+            result = Recommendation.find_serialized(product_id, recommendation_product_id, version)
+        if not result or not result["relationship"]:
             abort(status.HTTP_404_NOT_FOUND, "Recommendation for product id {} and {} was not found.".format(product_id, recommendation_product_id))
-        return recommendation.serialize(), status.HTTP_200_OK
+        return json_response(masked(recommendation_serializer).project(result), status.HTTP_200_OK, {'ETag': quote_etag(etag)})
 
     ##############################################################
     # UPDATE A RECOMMENDATION (RELATIONSHIP BETWEEN PRODUCTS)
@@ -166,12 +486,14 @@ class RecommendationResource(Resource):
     @api.doc('update_recommendations', security='apikey')
     @api.response(404, 'Recommendation not found')
     @api.response(400, 'The posted Recommendation data was not valid')
+    @api.response(412, 'The ETag given in If-Match is no longer current')
     @api.expect(create_model)
     @api.marshal_with(recommendation_model)
     def put(self, product_id, recommendation_product_id):
         """
         Update relationship between product id and recommended product id
         This endpoint will update a relationship based the data in the body that is posted
+        Send the ETag of an earlier read in If-Match to only update if nothing changed since.
         """
         app.logger.info("Request to update a recommenation")
         check_content_type("application/json")
@@ -181,15 +503,25 @@ class RecommendationResource(Resource):
             message = "Bad relationship input. Supported relationships are {}".format(supported_relationships)
             abort(status.HTTP_400_BAD_REQUEST, message)
 
-        recommendation = Recommendation.find(product_id, recommendation_product_id)
+        # the row, then the version, like every other write locks them
+        recommendation = Recommendation.find(product_id, recommendation_product_id, lock=True)
         if not recommendation:
+            db.session.rollback()
             abort(status.HTTP_404_NOT_FOUND, "Recommendation for product id {} and {} was not found.".format(product_id, recommendation_product_id))
-        
-        recommendation.deserialize(data)
 
-    
-        recommendation.update()
-        return recommendation.serialize(), status.HTTP_200_OK
+        # the version stays locked until update() commits, nobody can write in between
+        version = ProductVersion.lock(product_id)
+        try:
+            if request.if_match and not request.if_match.contains(product_etag(product_id, version)):
+                abort(status.HTTP_412_PRECONDITION_FAILED, "Recommendations for product id {} were modified.".format(product_id))
+            recommendation.deserialize(data)
+            recommendation.update()  # bumps the version once
+        except Exception:
+            # release the lock right away, other workers' writes to the product wait on it
+            db.session.rollback()
+            raise
+        etag = product_etag(product_id, version + 1)
+        return recommendation.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(etag)}
 
 
     ##############################################################
@@ -203,7 +535,8 @@ class RecommendationResource(Resource):
         Delete a relationship
         This endpoint will delete a relationship based the product ids specified in the path
         """
-        app.logger.info("Request to delete relationship between product ids: %s %s", product_id, recommendation_product_id)
+        app.logger.info("Request to delete relationship between product ids",
+                        extra=kv(product_id=product_id, recommendation_product_id=recommendation_product_id))
         recommendation = Recommendation.find(product_id, recommendation_product_id)
         if recommendation:
             recommendation.delete()
@@ -214,24 +547,133 @@ class RecommendationGroup(Resource):
     ######################################################################
     # QUERY RECOMMENDATIONS FOR ID AND TYPE
     ######################################################################
-    @api.doc('query_recommendations')
-    @api.marshal_list_with(recommendation_model)
+    @api.doc('query_recommendations', params=mask_params)
+    @api.response(200, 'Success', [recommendation_model])
+    @api.response(304, 'Not modified since the ETag given in If-None-Match')
     @api.response('400', 'Bad request')
     def get(self, product_id):
-        """ Returns all of the Recommendations """
+        """
+        Returns all of the Recommendations
+
+        The ETag changes on every write to the Recommendations of product_id.
+        """
         type = request.args.get('type')
         
-        app.logger.info("Request for recommendations query for id %s and type %s", product_id, type)
+        app.logger.info("Request for recommendations query", extra=kv(product_id=product_id, type=type))
         supported_relationships = [t.name for t in Type]
         
         if type and type not in supported_relationships:
             message = "Bad relationship input. Supported relationships are {}".format(supported_relationships)
             abort(status.HTTP_400_BAD_REQUEST, message)
 
-        recommendations = Recommendation.find_by_id_and_type(product_id, type)
+        # read the version before the rows, the snapshot and the cache only answer for that version,
+        # so the ETag is never newer than the body; a snapshot hit never goes to the database
+        snapshot, version = read_version(product_id)
+        etag = product_etag(product_id, version)
+        if request.if_none_match.contains_weak(etag):
+            return '', status.HTTP_304_NOT_MODIFIED, {'ETag': quote_etag(etag)}
 
-        results = [recommendation.serialize() for recommendation in recommendations]
-        return results, status.HTTP_200_OK
+        results = snapshot.find_group(product_id, type, version) if snapshot else MISSING
+        if results is MISSING:
+            results = Recommendation.find_group(product_id, type, version)
+        return masked(recommendation_serializer).response(results, status.HTTP_200_OK, {'ETag': quote_etag(etag)})
+
+    ######################################################################
+    # DELETE THE RECOMMENDATIONS OF A PRODUCT
+    ######################################################################
+    @api.doc('delete_product_recommendations', security='apikey')
+    @api.expect(delete_args, validate=True)
+    @api.response(400, 'Bad request')
+    @api.marshal_with(delete_result_model)
+    def delete(self, product_id):
+        """
+        Deletes the Recommendations of a product
+
+        With direction=both the Recommendations pointing at the product are deleted
+        too, e.g. when it is discontinued. Returns the number of Recommendations deleted.
+        """
+        args = delete_args.parse_args()
+        app.logger.info("Request to delete the recommendations of a product",
+                        extra=kv(product_id=product_id, type=args['type'], direction=args['direction']))
+        deleted = Recommendation.delete_products([product_id], args['type'], args['direction'] or 'out')
+        return {'deleted': deleted}, status.HTTP_200_OK
+
+@api.route('/recommendations/<int:product_id>/top')
+@api.param('product_id', 'The product identifier')
+class RecommendationTop(Resource):
+    ######################################################################
+    # QUERY THE MOST LIKED RECOMMENDATIONS FOR ID AND TYPE
+    ######################################################################
+    @api.doc('top_recommendations', params=mask_params)
+    @api.response(200, 'Success', [recommendation_model])
+    @api.expect(top_args, validate=True)
+    @api.response(400, 'Bad request')
+    def get(self, product_id):
+        """
+        Returns the most liked Recommendations for a product
+
+        Ordering and limiting is done by the database, backed by an index on
+        (product_id, relationship, likes DESC).
+        """
+        args = top_args.parse_args()
+        limit = min(args['limit'] or app.config['TOP_LIMIT_DEFAULT'], app.config['TOP_LIMIT_MAX'])
+        app.logger.info("Request for top recommendations", extra=kv(product_id=product_id, type=args['type'], limit=limit))
+
+        rows = Recommendation.find_top(product_id, args['type'], limit)
+
+        results = [Recommendation.serialize_row(row) for row in rows]
+        return masked(recommendation_serializer).response(results)
+
+@api.route('/recommendations/<int:product_id>/expanded')
+@api.param('product_id', 'The product identifier')
+class RecommendationExpanded(Resource):
+    ######################################################################
+    # QUERY THE PRODUCTS REACHABLE IN A FEW HOPS
+    ######################################################################
+    @api.doc('expanded_recommendations', params=mask_params)
+    @api.response(200, 'Success', [expanded_model])
+    @api.expect(expanded_args, validate=True)
+    @api.response(400, 'Bad request')
+    def get(self, product_id):
+        """
+        Returns the products reachable from a product in up to depth hops, best scored first
+
+        Answered from this worker's in-memory graph, products reached by more,
+        shorter and more liked paths score higher.
+        """
+        args = expanded_args.parse_args()
+        depth = min(args['depth'] or 2, app.config['GRAPH_MAX_DEPTH'])
+        limit = min(args['limit'] or app.config['GRAPH_LIMIT_DEFAULT'], app.config['GRAPH_LIMIT_MAX'])
+        app.logger.info("Request for expanded recommendations",
+                        extra=kv(product_id=product_id, type=args['type'], depth=depth, limit=limit))
+
+        results = get_graph().expand(product_id, depth, args['type'], limit)
+        return masked(expanded_serializer).response(results)
+
+@api.route('/recommended-products/<int:recommendation_product_id>/recommenders')
+@api.param('recommendation_product_id', 'The recommended product identifier')
+class RecommenderCollection(Resource):
+    ######################################################################
+    # QUERY THE RECOMMENDATIONS THAT POINT AT A PRODUCT
+    ######################################################################
+    @api.doc('query_recommenders', params=mask_params)
+    @api.response(200, 'Success', [recommendation_model])
+    @api.expect(recommenders_args, validate=True)
+    @api.response(400, 'Bad request')
+    def get(self, recommendation_product_id):
+        """
+        Returns all of the Recommendations that recommend a product
+
+        Use it to find the products affected when a product is retired or repriced.
+        """
+        args = recommenders_args.parse_args()
+        app.logger.info("Request for recommenders",
+                        extra=kv(recommendation_product_id=recommendation_product_id, type=args['type']))
+
+        rows = Recommendation.find_recommenders(recommendation_product_id, args['type'])
+
+        results = [Recommendation.serialize_row(row) for row in rows]
+        return masked(recommendation_serializer).response(results)
 
 @api.route('/recommendations', strict_slashes=False)
 class RecommendationCollection(Resource):
@@ -239,16 +681,47 @@ class RecommendationCollection(Resource):
     ######################################################################
     # LIST RECOMMENDATIONS
     ######################################################################
-    @api.doc('list_recommendations')
-    @api.marshal_list_with(recommendation_model)
+    @api.doc('list_recommendations', params=mask_params)
+    @api.expect(list_args, validate=True)
+    @api.response(200, 'Success', [recommendation_model])
+    @api.response(400, 'Bad request')
     def get(self):
-        """ Returns all of the Recommendations """
+        """
+        Returns a page of the Recommendations
+
+        Pages are ordered by (product_id, recommendation_product_id). When more rows
+        are available a Link header with rel="next" points at the following page.
+        With product_ids the Recommendations of those products are returned instead,
+        grouped by product id and resolved with a single query.
+        """
         app.logger.info("Request for recommendations list")
+        args = list_args.parse_args()
+        if args['product_ids']:
+            try:
+                product_ids = [int(product_id) for product_id in args['product_ids'].split(',')]
+            except ValueError:
+                abort(status.HTTP_400_BAD_REQUEST, "product_ids must be a comma separated list of integers")
+            if not all(MIN_ID <= product_id <= MAX_ID for product_id in product_ids):
+                abort(status.HTTP_400_BAD_REQUEST, "product_ids must be between {} and {}".format(MIN_ID, MAX_ID))
+            return lookup_products(product_ids, args['type'])
+
+        limit = min(args['limit'] or app.config['PAGE_SIZE_DEFAULT'], app.config['PAGE_SIZE_MAX'])
+        after = decode_cursor(args['after']) if args['after'] else None
 
-        recommendations = Recommendation.all()
+        # fetch one extra row to find out whether there is a next page
+        rows = Recommendation.find_page(after, limit + 1)
 
-        results = [recommendation.serialize() for recommendation in recommendations]
-        return results, status.HTTP_200_OK
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_url = api.url_for(RecommendationCollection, limit=limit,
+                                   after=encode_cursor(last.product_id, last.recommendation_product_id),
+                                   _external=True)
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+        results = [Recommendation.serialize_row(row) for row in rows]
+        return masked(recommendation_serializer).response(results, status.HTTP_200_OK, headers)
 
 
     ######################################################################
@@ -266,13 +739,12 @@ class RecommendationCollection(Resource):
         app.logger.info("Request to create a Recommendation")
         check_content_type("application/json")
         recommendation = Recommendation()
-        app.logger.info('Payload = %s', api.payload)
+        app.logger.debug("Payload", extra=kv(payload=api.payload))
         recommendation.deserialize(api.payload)
         supported_relationships = [t.name for t in Type]
         if recommendation.relationship not in supported_relationships:
             message = "Bad relationship input. Supported relationships are {}".format(supported_relationships)
             abort(status.HTTP_400_BAD_REQUEST, message)
-        app.logger.info('Payload = %s', api.payload)
         recommendation.create()
         location_url = api.url_for(RecommendationResource, product_id=recommendation.product_id, recommendation_product_id=recommendation.recommendation_product_id, _external=True)
         return recommendation.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
@@ -289,6 +761,166 @@ class RecommendationCollection(Resource):
         Recommendation.clear()
         return '', status.HTTP_204_NO_CONTENT
 
+@api.route('/recommendations/query')
+class RecommendationQuery(Resource):
+
+    ######################################################################
+    # QUERY RECOMMENDATIONS FOR MANY PRODUCT IDS
+    ######################################################################
+    @api.doc('query_recommendations_for_products')
+    @api.expect(product_query_model, validate=True)
+    @api.response(200, 'Success', products_model)
+    @api.response(400, 'Bad request')
+    def post(self):
+        """
+        Returns the Recommendations of many products grouped by product id
+
+        Same as GET /recommendations?product_ids=... for lists too long for a URL.
+        """
+        app.logger.info("Request for recommendations of many products")
+        check_content_type("application/json")
+        data = api.payload
+        return lookup_products(data['product_ids'], data.get('type'))
+
+@api.route('/recommendations/lookup')
+class RecommendationLookup(Resource):
+
+    ######################################################################
+    # LOOK UP MANY (PRODUCT, RECOMMENDED PRODUCT) PAIRS
+    ######################################################################
+    @api.doc('lookup_recommendations')
+    @api.expect(lookup_model, validate=True)
+    @api.response(400, 'Bad request')
+    @api.response(413, 'Too many pairs in one request')
+    @api.marshal_with(lookup_result_model)
+    def post(self):
+        """
+        Returns the Recommendations of many (product_id, recommendation_product_id) pairs
+
+        All pairs are resolved with one query on the primary key. Pairs without a
+        Recommendation are listed in missing, in the order they were asked for.
+        """
+        app.logger.info("Request to look up many recommendations")
+        check_content_type("application/json")
+        keys = [(pair['product_id'], pair['recommendation_product_id']) for pair in api.payload['pairs']]
+        if len(keys) > app.config['LOOKUP_MAX_PAIRS']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  "At most {} pairs can be looked up per request".format(app.config['LOOKUP_MAX_PAIRS']))
+
+        found = Recommendation.find_pairs(keys)
+        missing = [
+            {'product_id': key[0], 'recommendation_product_id': key[1]} for key in keys if key not in found
+        ]
+        return {'found': list(found.values()), 'missing': missing}, status.HTTP_200_OK
+
+@api.route('/recommendations/retire')
+class RecommendationRetirement(Resource):
+
+    ######################################################################
+    # DELETE THE RECOMMENDATIONS OF MANY PRODUCTS
+    ######################################################################
+    @api.doc('retire_products', security='apikey')
+    @api.expect(retire_model, validate=True)
+    @api.response(400, 'Bad request')
+    @api.response(413, 'Too many products in one request')
+    @api.marshal_with(delete_result_model)
+    def post(self):
+        """
+        Deletes the Recommendations of many products in one statement
+
+        Same as DELETE /recommendations/{id} for a list of products.
+        Returns the number of Recommendations deleted.
+        """
+        app.logger.info("Request to retire products")
+        check_content_type("application/json")
+        data = api.payload
+        if len(data['product_ids']) > app.config['RETIRE_MAX_PRODUCTS']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  "At most {} products can be retired per request".format(app.config['RETIRE_MAX_PRODUCTS']))
+        deleted = Recommendation.delete_products(data['product_ids'], data.get('type'), data.get('direction') or 'out')
+        app.logger.info("Retired products", extra=kv(products=len(data['product_ids']), deleted=deleted))
+        return {'deleted': deleted}, status.HTTP_200_OK
+
+@api.route('/recommendations/batch')
+class RecommendationBatch(Resource):
+
+    ######################################################################
+    # ADD MANY RECOMMENDATIONS IN ONE TRANSACTION
+    ######################################################################
+    @api.doc('create_recommendations_batch', security='apikey')
+    @api.response(400, 'The posted data was not a list of Recommendations')
+    @api.response(413, 'Too many Recommendations in one batch')
+    @api.expect([create_model])
+    @api.marshal_with(batch_result_model)
+    def post(self):
+        """
+        Creates many Recommendations in a single transaction
+
+        The body is a JSON array, or NDJSON with Content-Type application/x-ndjson.
+        Every item gets a status of created, duplicate or invalid; bad items do not
+        abort the rest of the batch.
+        """
+        app.logger.info("Request to create a batch of Recommendations")
+        check_content_type("application/json", NDJSON_MIMETYPE)
+        if request.headers["Content-Type"] == NDJSON_MIMETYPE:
+            records = []
+            for line in request.get_data(as_text=True).splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    records.append(None)  # reported as invalid
+        else:
+            records = api.payload
+            if not isinstance(records, list):
+                abort(status.HTTP_400_BAD_REQUEST, "Body must be a list of Recommendations")
+        if len(records) > app.config['BATCH_MAX_SIZE']:
+            abort(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                  "At most {} Recommendations can be created per batch".format(app.config['BATCH_MAX_SIZE']))
+
+        results = Recommendation.create_many(records, app.config['BATCH_CHUNK_SIZE'])
+        summary = {state: 0 for state in ("created", "duplicate", "invalid")}
+        for result in results:
+            summary[result["status"]] += 1
+        app.logger.info("Batch result", extra=kv(**summary))
+        summary["results"] = results
+        return summary, status.HTTP_200_OK
+
+@api.route('/recommendations/export')
+class RecommendationExport(Resource):
+
+    ######################################################################
+    # EXPORT ALL RECOMMENDATIONS
+    ######################################################################
+    @api.doc('export_recommendations')
+    @api.produces([NDJSON_MIMETYPE])
+    @api.response(200, 'One JSON encoded Recommendation per line')
+    @api.response(406, 'The client does not accept application/x-ndjson')
+    def get(self):
+        """
+        Streams all of the Recommendations as newline delimited JSON
+
+        Rows are read in chunks of EXPORT_CHUNK_SIZE and written out as they are
+        fetched, so the whole table is never held in memory.
+        """
+        app.logger.info("Request to export all recommendations")
+        if request.accept_mimetypes and not request.accept_mimetypes.best_match([NDJSON_MIMETYPE]):
+            abort(status.HTTP_406_NOT_ACCEPTABLE, "Accept must allow {}".format(NDJSON_MIMETYPE))
+        chunk_size = app.config['EXPORT_CHUNK_SIZE']
+
+        def generate():
+            rows = []
+            for row in Recommendation.stream_all(chunk_size):
+                rows.append(Recommendation.serialize_row(row))
+                if len(rows) >= chunk_size:
+                    yield recommendation_serializer.dumps_lines(rows)
+                    rows = []
+            if rows:
+                yield recommendation_serializer.dumps_lines(rows)
+
+        return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
 @api.route("/recommendations/<int:product_id>/recommended-products/<int:recommendation_product_id>/like")
 @api.param('product_id', 'The product identifier')
 @api.param('recommendation_product_id', 'The recommended product identifier')
@@ -299,18 +931,128 @@ class LikeResource(Resource):
     ######################################################################
     @api.doc('like_recommendations')
     @api.response(404, 'Recommendation not found')
+    @api.response(202, 'Like accepted, it will be written with the next flush')
     def put(self, product_id, recommendation_product_id):
         """
         Like a recommendation
+
+        The like count is incremented atomically by the database. In write-behind mode
+        the like is buffered and 202 is returned with the like count it will have once flushed.
         """
-        app.logger.info("Request to like a recommendation between %s and %s", product_id, recommendation_product_id)
-        
-        recommendation = Recommendation.find(product_id, recommendation_product_id)
-        if not recommendation:
+        app.logger.info("Request to like a recommendation",
+                        extra=kv(product_id=product_id, recommendation_product_id=recommendation_product_id))
+
+        buffer = get_like_buffer()
+        if buffer:
+            recommendation = Recommendation.find_serialized(product_id, recommendation_product_id)
+            if not recommendation:
+                abort(status.HTTP_404_NOT_FOUND, "Recommendation for product id {} and {} was not found.".format(product_id, recommendation_product_id))
+            waiting = buffer.add(product_id, recommendation_product_id)
+            result = dict(recommendation)  # do not modify the cached copy
+            result["likes"] = (result["likes"] or 0) + waiting
+            return result, status.HTTP_202_ACCEPTED
+
+        result = Recommendation.like(product_id, recommendation_product_id)
+        if not result:
             abort(status.HTTP_404_NOT_FOUND, "Recommendation for product id {} and {} was not found.".format(product_id, recommendation_product_id))
-        
-        recommendation.likes += 1
-        recommendation.update()
-        return recommendation.serialize(), status.HTTP_200_OK
+        return result, status.HTTP_200_OK
 
+@api.route('/internal/cache')
+class CacheStatsResource(Resource):
 
+    ######################################################################
+    # READ CACHE STATISTICS
+    ######################################################################
+    @api.doc('get_cache_stats')
+    @api.marshal_with(cache_stats_model)
+    def get(self):
+        """
+        Returns the read cache counters of this worker
+
+        Use the hit ratio and eviction count to size CACHE_MAX_ENTRIES and CACHE_TTL_SECONDS.
+        """
+        if Recommendation.cache is None:
+            return {'enabled': False}, status.HTTP_200_OK
+        stats = Recommendation.cache.stats()
+        stats['enabled'] = True
+        return stats, status.HTTP_200_OK
+
+@api.route('/internal/pool')
+class PoolStatsResource(Resource):
+
+    ######################################################################
+    # DATABASE CONNECTION POOL STATISTICS
+    ######################################################################
+    @api.doc('get_pool_stats')
+    @api.marshal_with(pool_stats_model, skip_none=True)
+    def get(self):
+        """
+        Returns the database connection pool statistics of this worker
+
+        Use them to size DB_POOL_SIZE and DB_MAX_OVERFLOW against the workers and max_connections.
+        """
+        return pool_stats(db.engine), status.HTTP_200_OK
+
+
+@api.route('/internal/profiles')
+class ProfileCollection(Resource):
+
+    ######################################################################
+    # LIST PROFILED REQUESTS
+    ######################################################################
+    @api.doc('list_profiles')
+    @api.response(403, 'The X-Profile-Token header is missing or wrong')
+    @api.marshal_list_with(profile_summary_model)
+    def get(self):
+        """
+        Returns the stored request profiles, newest first
+
+        A request is profiled when it sends X-Profile-Token or is sampled with PROFILE_SAMPLE_RATE.
+        """
+        check_profile_token()
+        store = request_profiler.store
+        summaries = (store.load(profile_id) for profile_id in store.ids())
+        return [summary for summary in summaries if summary], status.HTTP_200_OK
+
+@api.route('/internal/profiles/<string:profile_id>')
+@api.param('profile_id', 'The profile identifier')
+class ProfileResource(Resource):
+
+    ######################################################################
+    # READ A REQUEST PROFILE
+    ######################################################################
+    @api.doc('get_profile')
+    @api.response(403, 'The X-Profile-Token header is missing or wrong')
+    @api.response(404, 'Profile not found')
+    @api.marshal_with(profile_model)
+    def get(self, profile_id):
+        """
+        Returns a request profile with its SQL statements and a cProfile report
+        """
+        check_profile_token()
+        summary = request_profiler.store.load(profile_id)
+        if not summary:
+            abort(status.HTTP_404_NOT_FOUND, "Profile {} was not found.".format(profile_id))
+        return summary, status.HTTP_200_OK
+
+@api.route('/internal/profiles/<string:profile_id>/pstats')
+@api.param('profile_id', 'The profile identifier')
+class ProfileStatsResource(Resource):
+
+    ######################################################################
+    # DOWNLOAD THE CPROFILE STATS OF A REQUEST
+    ######################################################################
+    @api.doc('get_profile_stats')
+    @api.produces(['application/octet-stream'])
+    @api.response(403, 'The X-Profile-Token header is missing or wrong')
+    @api.response(404, 'Profile not found')
+    def get(self, profile_id):
+        """
+        Returns the raw cProfile stats of a request, to be opened with pstats or snakeviz
+        """
+        check_profile_token()
+        path = request_profiler.store.stats_path(profile_id)
+        if not path:
+            abort(status.HTTP_404_NOT_FOUND, "Profile {} was not found.".format(profile_id))
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                         attachment_filename='{}.prof'.format(profile_id))
@@ -0,0 +1,70 @@
+"""
+Fast JSON serialization for the read endpoints
+
+flask-restx marshalling walks every row field by field and then hands the
+result to the json module. For large lists that dominates the request, so the
+read endpoints project rows onto the fields of their Swagger model with a
+mapping compiled once, and encode them straight to bytes with orjson when it
+is installed (falling back to the json module). The response body is the
+same as the marshalled one, X-Fields masks included.
+"""
+import json
+from operator import itemgetter
+from flask import Response
+from flask_restx.mask import Mask
+
+try:
+    import orjson
+except ImportError:  # optional, only faster
+    orjson = None
+
+
+def dumps(data):
+    """ Encodes data as JSON bytes """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+class RowSerializer:
+    """ Turns serialized rows into JSON bytes shaped like a flask-restx model """
+
+    def __init__(self, model):
+        self.model = getattr(model, "resolved", model)
+        self.fields = tuple(self.model)
+        if len(self.fields) > 1:
+            self._getter = itemgetter(*self.fields)
+        else:  # itemgetter of one field does not return a tuple, a mask can select one field or none
+            self._getter = lambda row: tuple(row[field] for field in self.fields)
+
+    def masked(self, mask):
+        """
+        Returns a serializer of the fields selected by a fields mask, such as "{product_id,likes}"
+
+        Raises ParseError or MaskError like marshal_with does for an invalid mask
+        """
+        if not mask:
+            return self
+        return RowSerializer(Mask(mask, skip=True).apply(self.model))
+
+    def project(self, row):
+        """ Returns a dictionary with exactly the fields of the model """
+        return dict(zip(self.fields, self._getter(row)))
+
+    def project_all(self, rows):
+        """ Projects a list of rows """
+        fields, getter = self.fields, self._getter
+        return [dict(zip(fields, getter(row))) for row in rows]
+
+    def dumps_lines(self, rows):
+        """ Encodes rows as newline delimited JSON bytes """
+        return b"".join(dumps(row) + b"\n" for row in self.project_all(rows))
+
+    def response(self, rows, status=200, headers=None):
+        """ Returns a JSON Response with the list of rows """
+        return json_response(self.project_all(rows), status, headers)
+
+
+def json_response(data, status=200, headers=None):
+    """ Returns a Response with data encoded as JSON """
+    return Response(dumps(data), status=status, headers=headers, mimetype="application/json")
@@ -0,0 +1,216 @@
+"""
+Memory-mapped Recommendation snapshot
+
+build_snapshot() dumps the Recommendations into one binary file of fixed
+width, product sorted arrays (all little endian):
+
+  header      b"RECSNAP2", product count P and edge count E as uint64, then
+              the last ProductVersion.updated_seq read as int64
+  products    int64[P]     sorted product ids
+  versions    int64[P]     ProductVersion of each product when the snapshot was taken
+  offsets     int64[P + 1] the edges of products[i] are at offsets[i]:offsets[i + 1]
+  targets     int64[E]     recommendation_product_id, sorted within a product
+  likes       int64[E]
+  codes       int8[E]      Type value of the relationship
+
+Every worker maps the file read-only, so the operating system keeps a single
+copy in the page cache however many workers there are. The single and group
+GETs take their ETag from the versions recorded in the snapshot, a hit does
+not touch the database. Every SNAPSHOT_CHECK_SECONDS the reader reads the
+versions bumped since the last check, from GRAPH_SEQUENCE_MARGIN values
+behind it as the graph does, and marks the products written since the
+snapshot was built stale; the writes of this worker mark them at once. A
+stale product, or one missing from the snapshot, is read from the database.
+Other workers' writes are therefore served up to SNAPSHOT_CHECK_SECONDS
+late. A new snapshot is written next to the published one and renamed over
+it, workers pick it up within SNAPSHOT_CHECK_SECONDS.
+"""
+import os
+import mmap
+import time
+import struct
+import logging
+import threading
+import numpy as np
+from service.cache import MISSING
+from service.models import db, Recommendation, ProductVersion, Type
+
+logger = logging.getLogger("flask.app")
+
+MAGIC = b"RECSNAP2"
+HEADER = struct.Struct("<8sQQq")
+TYPE_NAMES = [member.name for member in sorted(Type, key=lambda member: member.value)]
+
+
+def build_snapshot(path, chunk_size=10000):
+    """ Writes a snapshot of the Recommendations to path, replacing it atomically, returns (products, edges) """
+    # versions first: a write committed while the rows are read makes the snapshot stale, never wrong
+    changes = ProductVersion.changed_since(-1)
+    versions = {product_id: version for product_id, version, _ in changes}
+    sequence = max((sequence for _, _, sequence in changes), default=0)
+    sources, targets, likes, codes = [], [], [], []
+    rows = []
+    for row in Recommendation.stream_all(chunk_size):
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            _append_chunk(rows, sources, targets, likes, codes)
+            rows = []
+    _append_chunk(rows, sources, targets, likes, codes)
+    sources, targets, likes, codes = (np.concatenate(arrays) for arrays in (sources, targets, likes, codes))
+
+    products = np.union1d(sources, np.fromiter(versions, dtype=np.int64, count=len(versions)))
+    product_versions = np.fromiter((versions.get(product_id, 0) for product_id in products.tolist()),
+                                   dtype=np.int64, count=len(products))
+    offsets = np.zeros(len(products) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(np.searchsorted(products, sources), minlength=len(products)), out=offsets[1:])
+
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, len(products), len(targets), sequence))
+        for array, dtype in ((products, "<i8"), (product_versions, "<i8"), (offsets, "<i8"),
+                             (targets, "<i8"), (likes, "<i8"), (codes, "<i1")):
+            snapshot_file.write(array.astype(dtype, copy=False).tobytes())
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary, path)
+    return len(products), len(targets)
+
+
+def _append_chunk(rows, sources, targets, likes, codes):
+    count = len(rows)
+    sources.append(np.fromiter((row[0] for row in rows), dtype=np.int64, count=count))
+    targets.append(np.fromiter((row[1] for row in rows), dtype=np.int64, count=count))
+    codes.append(np.fromiter((row[2].value for row in rows), dtype=np.int8, count=count))
+    likes.append(np.fromiter((row[3] or 0 for row in rows), dtype=np.int64, count=count))
+
+
+class Snapshot:
+    """ A read-only memory map of a snapshot file """
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            self.buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, product_count, edge_count, self.sequence = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError("{} is not a recommendation snapshot".format(path))
+        offset = HEADER.size
+        arrays = []
+        for dtype, count in (("<i8", product_count), ("<i8", product_count), ("<i8", product_count + 1),
+                             ("<i8", edge_count), ("<i8", edge_count), ("<i1", edge_count)):
+            arrays.append(np.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset))
+            offset += arrays[-1].nbytes
+        self.products, self.versions, self.offsets, self.targets, self.likes, self.codes = arrays
+        self.stale = set()
+        self.stale_all = False
+
+    def __len__(self):
+        return len(self.targets)
+
+    def mark_stale(self, product_id=None):
+        """ Stops answering for a product written since the snapshot was built, or for every product """
+        if product_id is None:
+            self.stale_all = True
+        else:
+            self.stale.add(product_id)
+
+    def version(self, product_id):
+        """ Returns the version of a product recorded in the snapshot, or MISSING if it cannot answer for it """
+        if self.stale_all or product_id in self.stale:
+            return MISSING
+        index = int(np.searchsorted(self.products, product_id))
+        if index == len(self.products) or self.products[index] != product_id:
+            return MISSING
+        return int(self.versions[index])
+
+    def _edges(self, product_id, version):
+        """ Returns the edge range of a product, or None if the snapshot cannot answer for it """
+        index = int(np.searchsorted(self.products, product_id))
+        if index == len(self.products) or self.products[index] != product_id or self.versions[index] != version:
+            return None
+        return int(self.offsets[index]), int(self.offsets[index + 1])
+
+    def find_group(self, product_id, type, version):
+        """ Returns the serialized Recommendations of a product and type, or MISSING """
+        edges = self._edges(product_id, version) if type in Type.__members__ else None
+        if edges is None:
+            return MISSING
+        start, end = edges
+        keep = self.codes[start:end] == Type[type].value
+        return [
+            {"product_id": product_id, "recommendation_product_id": target, "relationship": type, "likes": likes}
+            for target, likes in zip(self.targets[start:end][keep].tolist(), self.likes[start:end][keep].tolist())
+        ]
+
+    def find_pair(self, product_id, recommendation_product_id, version):
+        """ Returns the serialized Recommendation between two products, None if there is none, or MISSING """
+        edges = self._edges(product_id, version)
+        if edges is None:
+            return MISSING
+        start, end = edges
+        index = start + int(np.searchsorted(self.targets[start:end], recommendation_product_id))
+        if index == end or self.targets[index] != recommendation_product_id:
+            return None
+        return {"product_id": product_id, "recommendation_product_id": recommendation_product_id,
+                "relationship": TYPE_NAMES[self.codes[index]], "likes": int(self.likes[index])}
+
+
+class SnapshotReader:
+    """ Maps the snapshot published at path and switches to a new one when it is replaced """
+
+    def __init__(self, path, check_seconds=5.0, sequence_margin=10000, timer=time.monotonic):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.sequence_margin = sequence_margin
+        self.sequence = 0
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._checked = None
+        self._identity = None
+        self.snapshot = None
+
+    def current(self):
+        """ Returns the latest published Snapshot, or None if there is none """
+        now = self._timer()
+        if self._checked is not None and now - self._checked < self.check_seconds:
+            return self.snapshot
+        with self._lock:
+            if self._checked is None or now - self._checked >= self.check_seconds:
+                self._checked = now
+                self._reload()
+                self._check_versions()
+        return self.snapshot
+
+    def mark_dirty(self, product_id=None):
+        """ Stops serving a product written by this worker, or every product, from the current snapshot """
+        snapshot = self.snapshot
+        if snapshot is not None:
+            snapshot.mark_stale(product_id)
+
+    def _check_versions(self):
+        """ Marks the products whose version changed since the snapshot was built stale """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+        for product_id, version, sequence in ProductVersion.changed_since(self.sequence - self.sequence_margin):
+            if snapshot.version(product_id) not in (MISSING, version):
+                snapshot.mark_stale(product_id)
+            self.sequence = max(self.sequence, sequence)
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.snapshot, self._identity = None, None
+            return
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self._identity:
+            return
+        try:
+            snapshot = Snapshot(self.path)
+        except (OSError, ValueError, struct.error) as error:
+            logger.error("Could not map snapshot %s: %s", self.path, error)
+            return
+        # the previous map is released once the requests still using it are done
+        self.snapshot, self._identity = snapshot, identity
+        self.sequence = snapshot.sequence
+        logger.info("Mapped snapshot %s with %s recommendations", self.path, len(snapshot))
@@ -29,4 +29,13 @@ class RecommendationFactory(factory.Factory):
     product_id = FuzzyChoice(choices=[1, 2, 3, 4])
     recommendation_product_id = FuzzyChoice(choices=[5, 6, 7, 8])
     relationship = FuzzyChoice(choices=[Type.UP_SELL, Type.CROSS_SELL, Type.ACCESSORY])
-    
+
+
+class FakeTimer:
+    """ A clock that only moves when told to """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
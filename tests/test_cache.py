@@ -0,0 +1,68 @@
+"""
+Test cases for the in-process LRU cache
+
+"""
+import unittest
+from service.cache import LRUCache, MISSING
+from tests.factories import FakeTimer
+
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the LRUCache """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.timer = FakeTimer()
+        self.cache = LRUCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_get_and_set(self):
+        """Cache values and count hits and misses"""
+        self.assertIs(self.cache.get("a"), MISSING)
+        self.cache.set("a", 1)
+        self.cache.set("none", None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("none"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        self.assertAlmostEqual(stats["hit_ratio"], 2 / 3)
+
+    def test_evict_least_recently_used(self):
+        """Evict the least recently used entry when full"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIs(self.cache.get("b"), MISSING)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_expire_entries(self):
+        """Entries expire after the ttl"""
+        self.cache.set("a", 1)
+        self.timer.now = 9.9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.timer.now = 10
+        self.assertIs(self.cache.get("a"), MISSING)
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+
+    def test_drop_stale_entries(self):
+        """Entries that are no longer valid are dropped and counted as misses"""
+        self.cache.set("a", (1, "old"))
+        self.assertEqual(self.cache.get("a", valid=lambda entry: entry[0] == 1), (1, "old"))
+        self.assertIs(self.cache.get("a", valid=lambda entry: entry[0] == 2), MISSING)
+        self.assertEqual(len(self.cache), 0)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["expirations"]), (1, 1, 0))
+
+    def test_delete_and_clear(self):
+        """Delete single entries and clear the cache"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.delete("a", "missing")
+        self.assertIs(self.cache.get("a"), MISSING)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
@@ -0,0 +1,102 @@
+"""
+Test cases for queued and sampled logging
+
+"""
+import logging
+import unittest
+from flask import Flask
+from service.logs import kv, KeyValueFormatter, SamplingFilter, BackgroundQueueHandler, configure_logging
+
+
+class ListHandler(logging.Handler):
+    """ Keeps the formatted records it handles """
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def make_logger(name, *handlers):
+    logger = logging.getLogger(name)
+    logger.handlers = list(handlers)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger
+
+
+######################################################################
+#  L O G G I N G   T E S T   C A S E S
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the logging helpers """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.target = ListHandler()
+        self.target.setFormatter(KeyValueFormatter("%(levelname)s %(message)s"))
+
+    def test_key_value_fields(self):
+        """Append the key/value fields to the message"""
+        logger = make_logger("test.logs.fields", self.target)
+        logger.info("Request to like", extra=kv(product_id=1, type="UP_SELL"))
+        logger.info("Plain %s", "message")
+        self.assertEqual(self.target.lines, ["INFO Request to like product_id=1 type=UP_SELL", "INFO Plain message"])
+
+    def test_queue_handler(self):
+        """Write the records from the listener thread"""
+        handler = BackgroundQueueHandler([self.target])
+        logger = make_logger("test.logs.queue", handler)
+        payload = {"likes": 1}
+        logger.info("Payload", extra=kv(payload=payload))
+        logger.warning("Count %d", 2)
+        handler.close()
+        self.assertEqual(self.target.lines, ["INFO Payload payload={'likes': 1}", "WARNING Count 2"])
+        self.assertIsNone(handler.listener)
+
+    def test_sampling(self):
+        """Keep all or none of the INFO lines of a request"""
+        app = Flask(__name__)
+        logger = make_logger("test.logs.sampling", self.target)
+        draws = iter([0.9, 0.1])
+        logger.addFilter(SamplingFilter(0.5, random=lambda: next(draws)))
+        with app.test_request_context():
+            logger.info("dropped")
+            logger.debug("dropped")
+            logger.warning("kept")
+        with app.test_request_context():
+            logger.info("sampled")
+            logger.info("sampled again")
+        logger.info("outside of a request")
+        self.assertEqual(self.target.lines,
+                         ["WARNING kept", "INFO sampled", "INFO sampled again", "INFO outside of a request"])
+
+    def test_sampling_per_request(self):
+        """Draw again for every request when an app context stays pushed"""
+        app = Flask(__name__)
+        logger = make_logger("test.logs.sampling_per_request", self.target)
+        draws = iter([0.9, 0.1])
+        logger.addFilter(SamplingFilter(0.5, random=lambda: next(draws)))
+        # like init_db() does, g then outlives the requests
+        with app.app_context():
+            with app.test_request_context():
+                logger.info("dropped")
+            with app.test_request_context():
+                logger.info("sampled")
+        self.assertEqual(self.target.lines, ["INFO sampled"])
+
+    def test_configure_logging(self):
+        """Install the queue handler and the sampling filter from the config"""
+        app = Flask("test_configure_logging")
+        app.config.update(LOG_QUEUE_ENABLED=True, LOG_INFO_SAMPLE_RATE=0.5)
+        configure_logging(app, [self.target], logging.INFO)
+        try:
+            self.assertIsInstance(app.logger.handlers[0], BackgroundQueueHandler)
+            self.assertIsInstance(app.logger.filters[0], SamplingFilter)
+            self.assertIsInstance(self.target.formatter, KeyValueFormatter)
+        finally:
+            app.logger.handlers[0].close()
+            app.logger.handlers = []
+            app.logger.filters = []
@@ -6,7 +6,10 @@ import logging
 
 import unittest
 import os
-from service.models import Recommendation, DataValidationError, db, Type
+import threading
+import time
+from service.models import Recommendation, ProductVersion, DataValidationError, db, Type
+from service.cache import LRUCache
 from service import app
 from .factories import RecommendationFactory
 TEST_DATABASE_URI = os.getenv(
@@ -188,6 +191,264 @@ class TestRecommendationModel(unittest.TestCase):
         recommendation.update()
         self.assertEqual(recommendation.likes, 1)
         
+    def test_find_page(self):
+        """Page through recommendations in primary key order"""
+        for product_id in [2, 1]:
+            for recommendation_product_id in [4, 3]:
+                Recommendation(product_id=product_id, recommendation_product_id=recommendation_product_id,
+                               relationship=Type.UP_SELL).create()
+
+        page = Recommendation.find_page(limit=3)
+        self.assertEqual([(r.product_id, r.recommendation_product_id) for r in page],
+                         [(1, 3), (1, 4), (2, 3)])
+        page = Recommendation.find_page(after=(2, 3), limit=3)
+        self.assertEqual([(r.product_id, r.recommendation_product_id) for r in page], [(2, 4)])
+        self.assertEqual(Recommendation.find_page(after=(2, 4), limit=3), [])
+
+    def test_read_rows_without_orm_instances(self):
+        """Read column rows that stay out of the session"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL, likes=3).create()
+        db.session.expunge_all()
+        page = Recommendation.find_page(limit=10)
+        self.assertNotIsInstance(page[0], Recommendation)
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertEqual(Recommendation.serialize_row(page[0]),
+                         {"product_id": 1, "recommendation_product_id": 2, "relationship": "UP_SELL", "likes": 3})
+        self.assertEqual(Recommendation.find_group(1, "UP_SELL"), [Recommendation.serialize_row(page[0])])
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_create_many(self):
+        """Create a batch of recommendations in one transaction"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        records = [
+            {"product_id": 1, "recommendation_product_id": 2, "relationship": "UP_SELL"},
+            {"product_id": 1, "recommendation_product_id": 3, "relationship": "CROSS_SELL"},
+            {"product_id": 1, "recommendation_product_id": 3, "relationship": "CROSS_SELL"},
+            {"product_id": 1, "recommendation_product_id": 4, "relationship": "unsupported"},
+            {"product_id": "1", "recommendation_product_id": 4, "relationship": "UP_SELL"},
+            "this is not a dictionary",
+            {"product_id": 2, "recommendation_product_id": 1, "relationship": "ACCESSORY"},
+            {"product_id": 2 ** 70, "recommendation_product_id": 1, "relationship": "ACCESSORY"},
+        ]
+        results = Recommendation.create_many(records, chunk_size=2)
+        self.assertEqual([result["status"] for result in results],
+                         ["duplicate", "created", "duplicate", "invalid", "invalid", "invalid", "created", "invalid"])
+        self.assertIn("out of range", results[-1]["message"])
+        self.assertEqual(len(Recommendation.all()), 3)
+        recommendation = Recommendation.find(2, 1)
+        self.assertEqual(recommendation.relationship, Type.ACCESSORY)
+        self.assertEqual(recommendation.likes, 0)
+
+    def test_like_a_recommendation(self):
+        """Like a recommendation atomically"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        result = Recommendation.like(1, 2)
+        self.assertEqual(result["likes"], 1)
+        self.assertEqual(result["relationship"], "UP_SELL")
+        result = Recommendation.like(1, 2, count=3)
+        self.assertEqual(result["likes"], 4)
+        self.assertIsNone(Recommendation.like(2, 1))
+
+    def test_add_likes(self):
+        """Add likes to many recommendations in one statement"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=1, recommendation_product_id=3, relationship=Type.UP_SELL).create()
+        Recommendation.add_likes({(1, 2): 5, (1, 3): 1, (9, 9): 2})
+        db.session.expire_all()
+        self.assertEqual(Recommendation.find(1, 2).likes, 5)
+        self.assertEqual(Recommendation.find(1, 3).likes, 1)
+
+    def test_find_top(self):
+        """Find the most liked recommendations of a product"""
+        for recommendation_product_id, likes, relationship in [(2, 5, Type.UP_SELL), (3, 9, Type.UP_SELL),
+                                                              (4, 5, Type.UP_SELL), (5, 7, Type.ACCESSORY),
+                                                              (6, 1, Type.UP_SELL)]:
+            Recommendation(product_id=1, recommendation_product_id=recommendation_product_id,
+                           relationship=relationship, likes=likes).create()
+        Recommendation(product_id=2, recommendation_product_id=1, relationship=Type.UP_SELL, likes=99).create()
+
+        results = Recommendation.find_top(1, "UP_SELL", 3)
+        self.assertEqual([r.recommendation_product_id for r in results], [3, 2, 4])
+        results = Recommendation.find_top(1, limit=2)
+        self.assertEqual([r.recommendation_product_id for r in results], [3, 5])
+
+    def test_find_recommenders(self):
+        """Find the recommendations that point at a product"""
+        Recommendation(product_id=3, recommendation_product_id=9, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=1, recommendation_product_id=9, relationship=Type.ACCESSORY).create()
+        Recommendation(product_id=2, recommendation_product_id=9, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=9, recommendation_product_id=1, relationship=Type.UP_SELL).create()
+
+        results = Recommendation.find_recommenders(9)
+        self.assertEqual([r.product_id for r in results], [1, 2, 3])
+        results = Recommendation.find_recommenders(9, "UP_SELL")
+        self.assertEqual([r.product_id for r in results], [2, 3])
+
+    def test_read_through_cache(self):
+        """Serve pairs and groups from the cache and invalidate them on writes"""
+        Recommendation.cache = LRUCache()
+        try:
+            recommendation = Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL)
+            recommendation.create()
+            self.assertEqual(Recommendation.find_serialized(1, 2)["likes"], 0)
+            self.assertEqual(len(Recommendation.find_group(1, Type.UP_SELL)), 1)
+            self.assertIsNone(Recommendation.find_serialized(1, 3))
+
+            # hits do not touch the database
+            db.session.execute("DELETE FROM recommendation")
+            self.assertEqual(Recommendation.find_serialized(1, 2)["likes"], 0)
+            self.assertEqual(len(Recommendation.find_group(1, "UP_SELL")), 1)
+            self.assertEqual(Recommendation.cache.stats()["hits"], 2)
+            db.session.rollback()
+
+            Recommendation.like(1, 2)
+            self.assertEqual(Recommendation.find_serialized(1, 2)["likes"], 1)
+            self.assertEqual(Recommendation.find_group(1, "UP_SELL")[0]["likes"], 1)
+            Recommendation(product_id=1, recommendation_product_id=3, relationship=Type.UP_SELL).create()
+            self.assertIsNotNone(Recommendation.find_serialized(1, 3))
+            self.assertEqual(len(Recommendation.find_group(1, "UP_SELL")), 2)
+            Recommendation.find(1, 3).delete()
+            self.assertIsNone(Recommendation.find_serialized(1, 3))
+            Recommendation.clear()
+            self.assertIsNone(Recommendation.find_serialized(1, 2))
+            self.assertEqual(Recommendation.find_group(1, "UP_SELL"), [])
+        finally:
+            Recommendation.cache = None
+
+    def test_versioned_cache(self):
+        """Do not serve a cached read of an older version of the product"""
+        Recommendation.cache = LRUCache()
+        try:
+            Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+            version = ProductVersion.find_version(1)
+            self.assertEqual(Recommendation.find_serialized(1, 2, version)["likes"], 0)
+            self.assertEqual(Recommendation.find_group(1, "UP_SELL", version)[0]["likes"], 0)
+
+            # another worker's write bumps the version without invalidating this cache
+            db.session.execute("UPDATE recommendation SET likes = 5")
+            ProductVersion.bump([1])
+            db.session.commit()
+            self.assertEqual(Recommendation.find_serialized(1, 2, version)["likes"], 0)
+            version = ProductVersion.find_version(1)
+            self.assertEqual(Recommendation.find_serialized(1, 2, version)["likes"], 5)
+            self.assertEqual(Recommendation.find_group(1, "UP_SELL", version)[0]["likes"], 5)
+            self.assertEqual(Recommendation.find_serialized(1, 2, version)["likes"], 5)
+            self.assertEqual(Recommendation.cache.stats()["hits"], 2)
+        finally:
+            Recommendation.cache = None
+
+    def test_version_sequence(self):
+        """Stamp every bump with a later value of the sequence"""
+        ProductVersion.bump([1, 2])
+        db.session.commit()
+        first = max(sequence for _, _, sequence in ProductVersion.changed_since(0))
+        ProductVersion.bump([2, 3])
+        db.session.commit()
+        self.assertEqual(sorted(row[:2] for row in ProductVersion.changed_since(first)), [(2, 2), (3, 1)])
+        second = max(sequence for _, _, sequence in ProductVersion.changed_since(0))
+        ProductVersion.bump_all()
+        db.session.commit()
+        self.assertEqual(sorted(row[:2] for row in ProductVersion.changed_since(second)), [(1, 2), (2, 3), (3, 2)])
+
+    def test_product_version(self):
+        """Every write bumps the version of the product"""
+        self.assertEqual(ProductVersion.find_version(1), 0)
+        recommendation = Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL)
+        recommendation.create()
+        self.assertEqual(ProductVersion.find_version(1), 1)
+        recommendation.relationship = Type.CROSS_SELL
+        recommendation.update()
+        Recommendation.like(1, 2)
+        Recommendation.add_likes({(1, 2): 2})
+        self.assertEqual(ProductVersion.find_version(1), 4)
+        Recommendation.create_many([{"product_id": 1, "recommendation_product_id": 3, "relationship": "UP_SELL"},
+                                    {"product_id": 2, "recommendation_product_id": 3, "relationship": "UP_SELL"}])
+        self.assertEqual(ProductVersion.find_version(1), 5)
+        self.assertEqual(ProductVersion.find_version(2), 1)
+        recommendation.delete()
+        self.assertEqual(ProductVersion.find_version(1), 6)
+        Recommendation.clear()
+        self.assertEqual(ProductVersion.find_version(1), 7)
+        self.assertEqual(ProductVersion.find_version(2), 2)
+        self.assertEqual(ProductVersion.find_version(3), 0)
+
+    @unittest.skipUnless(TEST_DATABASE_URI.startswith("postgres"), "needs row locks")
+    def test_update_and_like_concurrently(self):
+        """Lock the row before the version in an update and a like of the same pair"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        locked, errors = threading.Event(), []
+
+        def update():
+            with app.app_context():
+                try:
+                    recommendation = Recommendation.find(1, 2, lock=True)
+                    ProductVersion.lock(1)
+                    locked.set()
+                    time.sleep(0.5)  # the like waits on the row meanwhile
+                    recommendation.relationship = Type.CROSS_SELL
+                    recommendation.update()
+                except Exception as error:  # a deadlock aborts one of the transactions
+                    errors.append(error)
+                finally:
+                    locked.set()
+                    db.session.remove()
+
+        def like():
+            with app.app_context():
+                try:
+                    locked.wait()
+                    Recommendation.like(1, 2)
+                except Exception as error:
+                    errors.append(error)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=update), threading.Thread(target=like)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        db.session.expire_all()
+        recommendation = Recommendation.find(1, 2)
+        self.assertEqual((recommendation.relationship, recommendation.likes), (Type.CROSS_SELL, 1))
+        self.assertEqual(ProductVersion.find_version(1), 3)
+
+    def test_lock_product_version(self):
+        """Lock the version of a product, creating it when the product was never written"""
+        self.assertEqual(ProductVersion.lock(1), 0)
+        db.session.commit()
+        self.assertEqual(ProductVersion.query.get(1).version, 0)
+        ProductVersion.bump([1])
+        self.assertEqual(ProductVersion.lock(1), 1)
+        db.session.commit()
+        self.assertEqual(ProductVersion.query.count(), 1)
+
+    def test_find_by_ids_and_type(self):
+        """Find the recommendations of many products"""
+        Recommendation(product_id=1, recommendation_product_id=3, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=2, recommendation_product_id=1, relationship=Type.ACCESSORY).create()
+        Recommendation(product_id=3, recommendation_product_id=1, relationship=Type.UP_SELL).create()
+
+        groups = Recommendation.find_by_ids_and_type([1, 2, 4])
+        self.assertEqual(sorted(groups), [1, 2, 4])
+        self.assertEqual([r["recommendation_product_id"] for r in groups[1]], [2, 3])
+        self.assertEqual(len(groups[2]), 1)
+        self.assertEqual(groups[4], [])
+        groups = Recommendation.find_by_ids_and_type([1, 2], "UP_SELL")
+        self.assertEqual((len(groups[1]), len(groups[2])), (2, 0))
+
+    def test_find_pairs(self):
+        """Find many pairs with one query"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=2, recommendation_product_id=1, relationship=Type.ACCESSORY).create()
+
+        found = Recommendation.find_pairs([(1, 2), (2, 1), (1, 3)])
+        self.assertEqual(sorted(found), [(1, 2), (2, 1)])
+        self.assertEqual(found[(2, 1)]["relationship"], "ACCESSORY")
+        self.assertEqual(Recommendation.find_pairs([]), {})
+
     def test_clear_data(self):
         '''Clear all data entries'''
         recommendations = RecommendationFactory.create_batch(1)
@@ -200,3 +461,23 @@ class TestRecommendationModel(unittest.TestCase):
 
 
 
+
+    def test_delete_products(self):
+        """Delete the Recommendations of many products in one statement"""
+        for product_id, recommendation_product_id, relationship in [
+                (1, 2, Type.UP_SELL), (1, 3, Type.CROSS_SELL), (2, 1, Type.UP_SELL), (3, 1, Type.ACCESSORY),
+                (3, 2, Type.UP_SELL), (4, 5, Type.UP_SELL)]:
+            Recommendation(product_id=product_id, recommendation_product_id=recommendation_product_id,
+                           relationship=relationship).create()
+        Recommendation.cache = LRUCache()
+        try:
+            self.assertIsNotNone(Recommendation.find_serialized(2, 1))
+            self.assertEqual(Recommendation.delete_products([1]), 2)
+            self.assertEqual(Recommendation.delete_products([1], "ACCESSORY", "in"), 1)
+            self.assertEqual(ProductVersion.find_version(3), 3)
+            self.assertEqual(Recommendation.delete_products([1, 2], direction="both"), 2)
+            self.assertIsNone(Recommendation.find_serialized(2, 1))
+            self.assertEqual(Recommendation.delete_products([]), 0)
+        finally:
+            Recommendation.cache = None
+        self.assertEqual([(r.product_id, r.recommendation_product_id) for r in Recommendation.all()], [(4, 5)])
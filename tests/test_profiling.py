@@ -0,0 +1,57 @@
+"""
+Test cases for the profile store
+
+"""
+import shutil
+import tempfile
+import unittest
+import cProfile
+from service.profiling import ProfileStore, new_id
+
+
+######################################################################
+#  P R O F I L E   S T O R E   T E S T   C A S E S
+######################################################################
+class TestProfileStore(unittest.TestCase):
+    """ Test Cases for the ProfileStore """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.directory = tempfile.mkdtemp()
+        self.store = ProfileStore(self.directory, max_profiles=2)
+
+    def tearDown(self):
+        """ This runs after each test """
+        shutil.rmtree(self.directory)
+
+    def save(self, profile_id):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        sorted(range(100))
+        profiler.disable()
+        self.store.save(profile_id, {"path": "/api/recommendations"}, profiler)
+
+    def test_save_and_load(self):
+        """Save a profile with its report and cProfile stats"""
+        profile_id = new_id()
+        self.save(profile_id)
+        summary = self.store.load(profile_id)
+        self.assertEqual(summary["id"], profile_id)
+        self.assertEqual(summary["path"], "/api/recommendations")
+        self.assertIn("function calls", summary["report"])
+        self.assertIsNotNone(self.store.stats_path(profile_id))
+
+    def test_keep_the_latest(self):
+        """Remove the oldest profiles beyond max_profiles"""
+        ids = ["20240101T00000000000{}-0000000{}".format(n, n) for n in range(4)]
+        for profile_id in ids:
+            self.save(profile_id)
+        self.assertEqual(self.store.ids(), [ids[3], ids[2]])
+        self.assertIsNone(self.store.load(ids[0]))
+        self.assertIsNone(self.store.stats_path(ids[0]))
+
+    def test_reject_unknown_ids(self):
+        """Only read ids made by new_id"""
+        self.assertIsNone(self.store.load("../../etc/passwd"))
+        self.assertIsNone(self.store.stats_path("../secret"))
+        self.assertIsNone(self.store.load(new_id()))
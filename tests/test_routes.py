@@ -6,13 +6,19 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import shutil
 import logging
+import tempfile
 from tests.factories import RecommendationFactory
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from service import status  # HTTP Status Codes
-from service.models import db, Recommendation, Type
+from service.models import db, Recommendation, ProductVersion, Type
+from service.cache import LRUCache
+from prometheus_client import REGISTRY
+from service import routes
 from service.routes import app, generate_apikey
+from service.snapshot import build_snapshot
 import json
 
 BASE_URL = "/api/recommendations"
@@ -43,7 +49,7 @@ class TestRecommendationServer(TestCase):
     @classmethod
     def tearDownClass(cls):
         """Run once after all tests"""
-        db.session.close()
+        db.session.remove()
 
     def setUp(self):
         """Runs before each test"""
@@ -82,6 +88,13 @@ class TestRecommendationServer(TestCase):
         resp = self.app.get("/")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_session_removed_after_request(self):
+        """ Every request ends with a new session, even with the app context of init_db pushed """
+        session = db.session()
+        resp = self.app.get(BASE_URL, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIsNot(db.session(), session)
+
     def test_get_recommendation(self):
         """ Get a single Recommendation """
         # get the id of a pet
@@ -94,6 +107,26 @@ class TestRecommendationServer(TestCase):
         self.assertEqual(data["relationship"],
                          test_recommendation.relationship.name)
 
+    def test_get_recommendations_with_fields_mask(self):
+        """ Select the fields of the read endpoints with an X-Fields mask """
+        recommendation = self._create_recommendations(1)[0]
+        url = BASE_URL + "/{}/recommended-products/{}".format(recommendation.product_id,
+                                                              recommendation.recommendation_product_id)
+        resp = self.app.get(url, headers={"X-Fields": "{relationship,likes}"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"relationship": recommendation.relationship.name, "likes": 0})
+        resp = self.app.get(BASE_URL + "/{}".format(recommendation.product_id),
+                            query_string="type=" + recommendation.relationship.name, headers={"X-Fields": "likes"})
+        self.assertEqual(resp.get_json(), [{"likes": 0}])
+        resp = self.app.get(BASE_URL, headers={"X-Fields": "recommendation_product_id"})
+        self.assertEqual(resp.get_json(), [{"recommendation_product_id": recommendation.recommendation_product_id}])
+        resp = self.app.get(url, headers={"X-Fields": "{likes"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        swagger = self.app.get("/api/swagger.json").get_json()
+        for path in ["/recommendations", "/recommendations/{product_id}",
+                     "/recommendations/{product_id}/recommended-products/{recommendation_product_id}"]:
+            self.assertIn("X-Fields", [param["name"] for param in swagger["paths"][path]["get"]["parameters"]])
+
     def test_get_recommendation_not_found(self):
         """ Get a Recommendation thats not found """
         resp = self.app.get(BASE_URL + "/0/recommended-products/0")
@@ -196,6 +229,117 @@ class TestRecommendationServer(TestCase):
         self.assertEqual(
             result_recommendation['relationship'], test_recommendation.relationship.name)
 
+    def test_list_recommendations_paginated(self):
+        """Page through the list of recommendations with a cursor"""
+        for recommendation_product_id in range(2, 7):
+            resp = self.app.post(
+                BASE_URL, json={"product_id": 1, "recommendation_product_id": recommendation_product_id,
+                                "relationship": "UP_SELL"},
+                content_type=CONTENT_TYPE_JSON, headers=self.headers
+            )
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+
+        seen = []
+        url = BASE_URL + "?limit=2"
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            result = resp.get_json()
+            self.assertLessEqual(len(result), 2)
+            seen.extend(r["recommendation_product_id"] for r in result)
+            link = resp.headers.get("Link")
+            url = link[link.index("<") + 1:link.index(">")] if link else None
+        self.assertEqual(seen, [2, 3, 4, 5, 6])
+
+    def test_list_recommendations_page_size_capped(self):
+        """The server caps the page size"""
+        for recommendation_product_id in [2, 3]:
+            Recommendation(product_id=1, recommendation_product_id=recommendation_product_id,
+                           relationship=Type.UP_SELL).create()
+        page_size_max = app.config["PAGE_SIZE_MAX"]
+        app.config["PAGE_SIZE_MAX"] = 1
+        try:
+            resp = self.app.get(BASE_URL + "?limit=100")
+        finally:
+            app.config["PAGE_SIZE_MAX"] = page_size_max
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertIn('rel="next"', resp.headers.get("Link"))
+
+    def test_list_recommendations_bad_cursor(self):
+        """Page with a cursor that cannot be decoded"""
+        resp = self.app.get(BASE_URL + "?after=not-a-cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL + "?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_recommendations_batch(self):
+        """Create a batch of recommendations"""
+        records = [
+            {"product_id": 1, "recommendation_product_id": 2, "relationship": "UP_SELL"},
+            {"product_id": 1, "recommendation_product_id": 2, "relationship": "UP_SELL"},
+            {"product_id": 1, "recommendation_product_id": 3, "relationship": "unsupported"},
+            {"product_id": 1, "recommendation_product_id": 2 ** 70, "relationship": "UP_SELL"},
+        ]
+        resp = self.app.post(BASE_URL + "/batch", json=records, content_type=CONTENT_TYPE_JSON, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual((data["created"], data["duplicate"], data["invalid"]), (1, 1, 2))
+        self.assertEqual([result["status"] for result in data["results"]], ["created", "duplicate", "invalid", "invalid"])
+        resp = self.app.get(BASE_URL + "/1/recommended-products/2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_create_recommendations_batch_ndjson(self):
+        """Create a batch of recommendations from NDJSON"""
+        body = '{"product_id": 1, "recommendation_product_id": 2, "relationship": "UP_SELL"}\n' \
+               'not json\n' \
+               '{"product_id": 1, "recommendation_product_id": 3, "relationship": "ACCESSORY"}\n'
+        resp = self.app.post(BASE_URL + "/batch", data=body, content_type="application/x-ndjson",
+                             headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual((data["created"], data["duplicate"], data["invalid"]), (2, 0, 1))
+
+    def test_create_recommendations_batch_bad_request(self):
+        """Create a batch that is not a list or is too large"""
+        resp = self.app.post(BASE_URL + "/batch", json={"product_id": 1}, content_type=CONTENT_TYPE_JSON,
+                             headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        batch_max_size = app.config["BATCH_MAX_SIZE"]
+        app.config["BATCH_MAX_SIZE"] = 1
+        try:
+            resp = self.app.post(BASE_URL + "/batch", json=[{}, {}], content_type=CONTENT_TYPE_JSON,
+                                 headers=self.headers)
+        finally:
+            app.config["BATCH_MAX_SIZE"] = batch_max_size
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        resp = self.app.post(BASE_URL + "/batch", headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_export_recommendations(self):
+        """Stream all recommendations as NDJSON"""
+        for recommendation_product_id in range(2, 5):
+            Recommendation(product_id=1, recommendation_product_id=recommendation_product_id,
+                           relationship=Type.UP_SELL).create()
+        export_chunk_size = app.config["EXPORT_CHUNK_SIZE"]
+        app.config["EXPORT_CHUNK_SIZE"] = 2
+        try:
+            resp = self.app.get(BASE_URL + "/export", headers={"Accept": "application/x-ndjson"})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            lines = resp.get_data(as_text=True).splitlines()
+        finally:
+            app.config["EXPORT_CHUNK_SIZE"] = export_chunk_size
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row["recommendation_product_id"] for row in rows], [2, 3, 4])
+        self.assertEqual(rows[0]["relationship"], "UP_SELL")
+        self.assertEqual(rows[0]["likes"], 0)
+
+    def test_export_recommendations_not_acceptable(self):
+        """Export to a client that only accepts JSON"""
+        resp = self.app.get(BASE_URL + "/export", headers={"Accept": "application/json"})
+        self.assertEqual(resp.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
     def test_update_recommendation(self):
         """Update an existing recommendation"""
         # create a recommendation to update
@@ -322,6 +466,147 @@ class TestRecommendationServer(TestCase):
         )
         self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
                
+    def test_query_top_recommendations(self):
+        """Query the most liked recommendations of a product"""
+        for recommendation_product_id, likes in [(2, 1), (3, 3), (4, 2)]:
+            Recommendation(product_id=1, recommendation_product_id=recommendation_product_id,
+                           relationship=Type.UP_SELL, likes=likes).create()
+        Recommendation(product_id=1, recommendation_product_id=5, relationship=Type.ACCESSORY, likes=9).create()
+
+        resp = self.app.get(BASE_URL + "/1/top?limit=2&type=UP_SELL")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["recommendation_product_id"] for r in resp.get_json()], [3, 4])
+        resp = self.app.get(BASE_URL + "/1/top")
+        self.assertEqual([r["recommendation_product_id"] for r in resp.get_json()], [5, 3, 4, 2])
+        resp = self.app.get(BASE_URL + "/1/top?type=unsupported")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_recommenders(self):
+        """Query the recommendations that point at a product"""
+        Recommendation(product_id=1, recommendation_product_id=9, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=2, recommendation_product_id=9, relationship=Type.ACCESSORY).create()
+
+        resp = self.app.get("/api/recommended-products/9/recommenders")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["product_id"] for r in resp.get_json()], [1, 2])
+        resp = self.app.get("/api/recommended-products/9/recommenders?type=ACCESSORY")
+        self.assertEqual([r["product_id"] for r in resp.get_json()], [2])
+        resp = self.app.get("/api/recommended-products/9/recommenders?type=unsupported")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_conditional_get(self):
+        """Answer If-None-Match with 304 until the product is written"""
+        test_recommendation = self._create_recommendations(1)[0]
+        group_url = BASE_URL + "/{}?type={}".format(test_recommendation.product_id,
+                                                    test_recommendation.relationship.name)
+        pair_url = BASE_URL + "/{}/recommended-products/{}".format(test_recommendation.product_id,
+                                                                  test_recommendation.recommendation_product_id)
+        for url in [group_url, pair_url]:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            etag = resp.headers["ETag"]
+            resp = self.app.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(len(resp.data), 0)
+            self.assertEqual(resp.headers["ETag"], etag)
+
+        resp = self.app.put(pair_url + "/like", headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(group_url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.get_json()[0]["likes"], 1)
+
+    def test_conditional_update(self):
+        """Only update when If-Match holds the current ETag"""
+        test_recommendation = self._create_recommendations(1)[0]
+        url = BASE_URL + "/{}/recommended-products/{}".format(test_recommendation.product_id,
+                                                             test_recommendation.recommendation_product_id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        data = resp.get_json()
+        data["relationship"] = "ACCESSORY"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON,
+                            headers=dict(self.headers, **{"If-Match": etag}))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_etag = resp.headers["ETag"]
+        self.assertEqual(self.app.get(url).headers["ETag"], new_etag)
+
+        # a second writer holding the old ETag is refused
+        data["relationship"] = "GO_TOGETHER"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON,
+                            headers=dict(self.headers, **{"If-Match": etag}))
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get(url).get_json()["relationship"], "ACCESSORY")
+
+    def test_query_recommendations_for_products(self):
+        """Query the recommendations of many products at once"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        Recommendation(product_id=2, recommendation_product_id=1, relationship=Type.ACCESSORY).create()
+
+        resp = self.app.get(BASE_URL + "?product_ids=1,2,3")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(sorted(data), ["1", "2", "3"])
+        self.assertEqual(data["1"][0]["recommendation_product_id"], 2)
+        self.assertEqual(data["3"], [])
+        resp = self.app.get(BASE_URL + "?product_ids=1,2&type=ACCESSORY")
+        data = resp.get_json()
+        self.assertEqual((len(data["1"]), len(data["2"])), (0, 1))
+
+        resp = self.app.post(BASE_URL + "/query", json={"product_ids": [2], "type": "ACCESSORY"},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["2"][0]["relationship"], "ACCESSORY")
+
+    def test_query_recommendations_for_products_bad_request(self):
+        """Query the recommendations of many products with bad ids"""
+        resp = self.app.get(BASE_URL + "?product_ids=1,two")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + "/query", json={"type": "UP_SELL"}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(BASE_URL + "?product_ids=1,99999999999999999999")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + "/query", json={"product_ids": [1, 99999999999999999999]},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        max_product_ids = app.config["MAX_PRODUCT_IDS"]
+        app.config["MAX_PRODUCT_IDS"] = 2
+        try:
+            resp = self.app.get(BASE_URL + "?product_ids=1,2,3")
+        finally:
+            app.config["MAX_PRODUCT_IDS"] = max_product_ids
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_recommendations(self):
+        """Look up many pairs at once"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        pairs = [{"product_id": 1, "recommendation_product_id": 2},
+                 {"product_id": 1, "recommendation_product_id": 3}]
+        resp = self.app.post(BASE_URL + "/lookup", json={"pairs": pairs}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data["found"]), 1)
+        self.assertEqual(data["found"][0]["relationship"], "UP_SELL")
+        self.assertEqual(data["missing"], [{"product_id": 1, "recommendation_product_id": 3}])
+
+    def test_lookup_recommendations_bad_request(self):
+        """Look up pairs with bad or too many pairs"""
+        resp = self.app.post(BASE_URL + "/lookup", json={"pairs": [{"product_id": 1}]},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + "/lookup", json={"pairs": [{"product_id": 2 ** 70, "recommendation_product_id": 2}]},
+                             content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        lookup_max_pairs = app.config["LOOKUP_MAX_PAIRS"]
+        app.config["LOOKUP_MAX_PAIRS"] = 1
+        try:
+            pairs = [{"product_id": 1, "recommendation_product_id": 2}, {"product_id": 1, "recommendation_product_id": 3}]
+            resp = self.app.post(BASE_URL + "/lookup", json={"pairs": pairs}, content_type=CONTENT_TYPE_JSON)
+        finally:
+            app.config["LOOKUP_MAX_PAIRS"] = lookup_max_pairs
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
     def test_clear_all_recommendations(self):
         """ Delete all recommendations"""
         self._create_recommendations(1)[0]
@@ -343,6 +628,43 @@ class TestRecommendationServer(TestCase):
         result = resp.get_json()
         self.assertEqual(len(result), 0)
 
+    def test_delete_product_recommendations(self):
+        """Delete the Recommendations of a product"""
+        for product_id, recommendation_product_id, relationship in [
+                (1, 2, Type.UP_SELL), (1, 3, Type.CROSS_SELL), (2, 1, Type.UP_SELL), (3, 2, Type.UP_SELL)]:
+            Recommendation(product_id=product_id, recommendation_product_id=recommendation_product_id,
+                           relationship=relationship).create()
+        etag = self.app.get(BASE_URL + "/2", query_string="type=UP_SELL").headers["ETag"]
+        resp = self.app.delete(BASE_URL + "/1", query_string="type=UP_SELL", headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"deleted": 1})
+        resp = self.app.delete(BASE_URL + "/1", query_string="direction=both", headers=self.headers)
+        self.assertEqual(resp.get_json(), {"deleted": 2})
+        resp = self.app.get(BASE_URL + "/2", query_string="type=UP_SELL", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.delete(BASE_URL + "/1", query_string="direction=sideways", headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(Recommendation.all()), 1)
+
+    def test_retire_products(self):
+        """Delete the Recommendations of many products"""
+        for product_id, recommendation_product_id in [(1, 2), (2, 3), (3, 4), (4, 1), (5, 6)]:
+            Recommendation(product_id=product_id, recommendation_product_id=recommendation_product_id,
+                           relationship=Type.UP_SELL).create()
+        resp = self.app.post(BASE_URL + "/retire", json={"product_ids": [1, 2], "direction": "both"},
+                             headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"deleted": 3})
+        self.assertEqual([(r.product_id, r.recommendation_product_id) for r in Recommendation.all()], [(3, 4), (5, 6)])
+        resp = self.app.post(BASE_URL + "/retire", json={"product_ids": [3], "direction": "up"}, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(BASE_URL + "/retire", json={"product_ids": [99999999999999999999]}, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.config, RETIRE_MAX_PRODUCTS=1):
+            resp = self.app.post(BASE_URL + "/retire", json={"product_ids": [3, 5]}, headers=self.headers)
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
     def test_like_recommendation(self):
         """Like an existing recommendation"""
         # create a recommendation to like
@@ -367,8 +689,151 @@ class TestRecommendationServer(TestCase):
         data = resp.get_json()
         self.assertEqual(data["likes"], 1)
 
+    def test_like_recommendation_write_behind(self):
+        """Like a recommendation with the write-behind buffer"""
+        test_recommendation = self._create_recommendations(1)[0]
+        url = BASE_URL + "/{}/recommended-products/{}".format(test_recommendation.product_id,
+                                                             test_recommendation.recommendation_product_id)
+        app.config["LIKE_WRITE_BEHIND"] = True
+        app.config["LIKE_FLUSH_INTERVAL_MS"] = 60000
+        try:
+            for likes in [1, 2]:
+                resp = self.app.put(url + "/like", headers=self.headers)
+                self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+                self.assertEqual(resp.get_json()["likes"], likes)
+            resp = self.app.put(BASE_URL + "/0/recommended-products/0/like", headers=self.headers)
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(self.app.get(url).get_json()["likes"], 0)
+            self.assertEqual(routes.like_buffer.flush(), 1)
+        finally:
+            app.config["LIKE_WRITE_BEHIND"] = False
+            app.config["LIKE_FLUSH_INTERVAL_MS"] = 100
+            routes.like_buffer = None
+        db.session.expire_all()
+        self.assertEqual(self.app.get(url).get_json()["likes"], 2)
+
+    def test_get_cache_stats(self):
+        """Get the read cache counters"""
+        resp = self.app.get("/api/internal/cache")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertFalse(resp.get_json()["enabled"])
+
+        Recommendation.cache = LRUCache()
+        try:
+            test_recommendation = self._create_recommendations(1)[0]
+            url = BASE_URL + "/{}/recommended-products/{}".format(test_recommendation.product_id,
+                                                                 test_recommendation.recommendation_product_id)
+            for _ in range(3):
+                self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+            resp = self.app.get("/api/internal/cache")
+        finally:
+            Recommendation.cache = None
+        data = resp.get_json()
+        self.assertTrue(data["enabled"])
+        self.assertEqual((data["hits"], data["misses"], data["size"]), (2, 1, 1))
+
+    def test_get_pool_stats(self):
+        """Get the connection pool statistics"""
+        resp = self.app.get("/api/internal/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("pool_class", resp.get_json())
+
     def test_like_recommendation_not_found(self):
         """ Like a Recommendation thats not found """
         resp = self.app.put(
             BASE_URL + "/0/recommended-products/0/like", headers=self.headers)
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_metrics(self):
+        """Count requests, statements and likes in the Prometheus metrics"""
+        route = BASE_URL + "/<int:product_id>/recommended-products/<int:recommendation_product_id>/like"
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0.0
+        requests = sample("http_requests_total", route=route, method="PUT", status="200")
+        likes = sample("likes_written_total", mode="sync")
+        queries = sample("db_queries_per_request_sum", route=route)
+
+        test_recommendation = self._create_recommendations(1)[0]
+        resp = self.app.put(BASE_URL + "/{}/recommended-products/{}/like".format(
+            test_recommendation.product_id, test_recommendation.recommendation_product_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(sample("http_requests_total", route=route, method="PUT", status="200"), requests + 1)
+        self.assertEqual(sample("likes_written_total", mode="sync"), likes + 1)
+        self.assertGreater(sample("db_queries_per_request_sum", route=route), queries)
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(b"http_request_duration_seconds_bucket", resp.data)
+
+    def test_profile_request(self):
+        """Profile a request sending the token and read the profile back"""
+        directory = tempfile.mkdtemp()
+        profiler = routes.request_profiler
+        try:
+            with patch.object(profiler, "token", "secret"), \
+                    patch.object(profiler.store, "directory", directory):
+                test_recommendation = self._create_recommendations(1)[0]
+                url = BASE_URL + "/{}/recommended-products/{}".format(
+                    test_recommendation.product_id, test_recommendation.recommendation_product_id)
+                resp = self.app.get(url)
+                self.assertNotIn("X-Profile-Id", resp.headers)
+                resp = self.app.get(url, headers={"X-Profile-Token": "secret"})
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                profile_id = resp.headers["X-Profile-Id"]
+
+                resp = self.app.get("/api/internal/profiles", headers={"X-Profile-Token": "wrong"})
+                self.assertEqual(resp.status_code, status.HTTP_403_FORBIDDEN)
+                resp = self.app.get("/api/internal/profiles", headers={"X-Profile-Token": "secret"})
+                self.assertEqual([profile["id"] for profile in resp.get_json()], [profile_id])
+                resp = self.app.get("/api/internal/profiles/" + profile_id, headers={"X-Profile-Token": "secret"})
+                data = resp.get_json()
+                self.assertEqual(data["status"], status.HTTP_200_OK)
+                self.assertGreater(data["sql_count"], 0)
+                self.assertIn("SELECT", data["sql"][0]["statement"])
+                resp = self.app.get("/api/internal/profiles/{}/pstats".format(profile_id),
+                                    headers={"X-Profile-Token": "secret"})
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                resp.close()
+                resp = self.app.get("/api/internal/profiles/20240101T000000000000-00000000",
+                                    headers={"X-Profile-Token": "secret"})
+                self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_expanded_recommendations(self):
+        """Get the products reachable in two hops"""
+        for product_id, recommendation_product_id in [(1, 2), (2, 3), (2, 4)]:
+            Recommendation(product_id=product_id, recommendation_product_id=recommendation_product_id,
+                           relationship=Type.GO_TOGETHER).create()
+        try:
+            resp = self.app.get(BASE_URL + "/1/expanded", query_string="depth=2&type=GO_TOGETHER")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual([(r["product_id"], r["depth"]) for r in resp.get_json()], [(2, 1), (3, 2), (4, 2)])
+            resp = self.app.get(BASE_URL + "/1/expanded", query_string="depth=1&limit=5")
+            self.assertEqual([r["product_id"] for r in resp.get_json()], [2])
+            resp = self.app.get(BASE_URL + "/1/expanded", query_string="type=unknown")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            Recommendation.graph = None
+
+    def test_read_from_snapshot(self):
+        """Serve reads from the published snapshot and the database once it is stale"""
+        Recommendation(product_id=1, recommendation_product_id=2, relationship=Type.UP_SELL).create()
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "snapshot")
+        build_snapshot(path)
+        try:
+            with patch.dict(app.config, SNAPSHOT_PATH=path), patch.object(Recommendation, "snapshot_reader", None):
+                with patch.object(Recommendation, "find_group", side_effect=AssertionError("read the database")), \
+                        patch.object(ProductVersion, "find_version", side_effect=AssertionError("read the version")):
+                    resp = self.app.get(BASE_URL + "/1", query_string="type=UP_SELL")
+                    self.assertEqual([r["recommendation_product_id"] for r in resp.get_json()], [2])
+                    resp = self.app.get(BASE_URL + "/1/recommended-products/3")
+                    self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+                Recommendation(product_id=1, recommendation_product_id=3, relationship=Type.UP_SELL).create()
+                resp = self.app.get(BASE_URL + "/1", query_string="type=UP_SELL")
+                self.assertEqual([r["recommendation_product_id"] for r in resp.get_json()], [2, 3])
+                resp = self.app.get(BASE_URL + "/1/recommended-products/3")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,62 @@
+"""
+Test cases for the fast JSON serializers
+
+"""
+import json
+import unittest
+from unittest.mock import patch
+from flask import Flask
+from flask_restx import Api, fields, marshal
+from service import serializers
+from service.serializers import RowSerializer, json_response
+
+api = Api(Flask(__name__))
+base_model = api.model("Base", {"id": fields.Integer(), "name": fields.String()})
+model = api.inherit("Row", base_model, {"likes": fields.Integer()})
+
+ROWS = [
+    {"id": 1, "name": "one", "likes": 3, "ignored": True},
+    {"id": 2, "name": "two", "likes": 0, "ignored": False},
+]
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(unittest.TestCase):
+    """ Test Cases for RowSerializer and json_response """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.serializer = RowSerializer(model)
+
+    def test_project_matches_marshal(self):
+        """Project rows exactly like flask-restx marshals them"""
+        self.assertEqual(self.serializer.project(ROWS[0]), dict(marshal(ROWS[0], model)))
+        self.assertEqual(self.serializer.project_all(ROWS), [dict(row) for row in marshal(ROWS, model)])
+
+    def test_masked_matches_marshal(self):
+        """Apply fields masks exactly like flask-restx marshals them"""
+        self.assertIs(self.serializer.masked(None), self.serializer)
+        for mask in ["likes", "{likes,id}", "{unknown}"]:
+            self.assertEqual(self.serializer.masked(mask).project_all(ROWS),
+                             [dict(row) for row in marshal(ROWS, model, mask=mask)])
+
+    def test_dumps_lines(self):
+        """Encode rows as newline delimited JSON"""
+        lines = self.serializer.dumps_lines(ROWS).decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line) for line in lines], self.serializer.project_all(ROWS))
+
+    def test_response(self):
+        """Return a JSON response with the projected rows"""
+        resp = self.serializer.response(ROWS, status=201, headers={"ETag": '"1-0"'})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(resp.headers["ETag"], '"1-0"')
+        self.assertEqual(json.loads(resp.get_data()), self.serializer.project_all(ROWS))
+
+    def test_json_fallback(self):
+        """Encode with the json module when orjson is missing"""
+        with patch.object(serializers, "orjson", None):
+            resp = json_response({"a": [1, 2]})
+        self.assertEqual(resp.get_data(), b'{"a":[1,2]}')